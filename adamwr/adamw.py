@@ -17,20 +17,23 @@ class AdamW(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
+        foreach (boolean, optional): whether to update all parameters of a group
+            by multi-tensor (`torch._foreach_*`) operations (default: True)
 
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, foreach=True):
         if not 0.0 <= betas[0] < 1.0:
             raise ValueError(f'Invalid beta parameter at index 0: {betas[0]}')
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError(f'Invalid beta parameter at index 1: {betas[1]}')
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad, foreach=foreach)
         # super(AdamW, self).__init__(params, defaults)
         super().__init__(params, defaults)
 
+    @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -40,19 +43,22 @@ class AdamW(Optimizer):
         """
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         for group in self.param_groups:
+            params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, step_sizes = \
+                [], [], [], [], [], []
+            amsgrad = group['amsgrad']
+            beta1, beta2 = group['betas']
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         'Adam does not support sparse gradients, '
                         'please consider SparseAdam instead'
                     )
-                amsgrad = group['amsgrad']
 
                 state = self.state[p]
 
@@ -60,40 +66,75 @@ class AdamW(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
+                    state['exp_avg'] = torch.zeros_like(p)
                     # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
                     if amsgrad:
                         # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                if amsgrad:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
-                beta1, beta2 = group['betas']
+                        state['max_exp_avg_sq'] = torch.zeros_like(p)
 
                 state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
 
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+                params.append(p)
+                grads.append(p.grad)
+                exp_avgs.append(state['exp_avg'])
+                exp_avg_sqs.append(state['exp_avg_sq'])
                 if amsgrad:
-                    # Maintains the maximum of all 2nd moment running avg. till now
-                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
-                    # Use the max. for normalizing running avg. of gradient
-                    denom = max_exp_avg_sq.sqrt().add_(group['eps'])
-                else:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
+                    max_exp_avg_sqs.append(state['max_exp_avg_sq'])
+                step_sizes.append(
+                    -group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+                )
 
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+            if not params:
+                continue
 
-                if group['weight_decay'] != 0:
-                    decayed_weights = torch.mul(p.data, group['weight_decay'])
-                    p.data.addcdiv_(-step_size, exp_avg, denom)
-                    p.data.sub_(decayed_weights)
-                else:
-                    p.data.addcdiv_(-step_size, exp_avg, denom)
+            func = _multi_tensor_adamw if group.get('foreach', self.defaults['foreach']) else _single_tensor_adamw
+            func(params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, step_sizes,
+                 beta1=beta1, beta2=beta2, eps=group['eps'],
+                 weight_decay=group['weight_decay'], amsgrad=amsgrad)
 
         return loss
+
+
+def _single_tensor_adamw(params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, step_sizes,
+                         *, beta1, beta2, eps, weight_decay, amsgrad):
+    for i, (p, grad, exp_avg, exp_avg_sq) in enumerate(zip(params, grads, exp_avgs, exp_avg_sqs)):
+        # Decay the first and second moment running average coefficient
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        if amsgrad:
+            # Maintains the maximum of all 2nd moment running avg. till now
+            torch.max(max_exp_avg_sqs[i], exp_avg_sq, out=max_exp_avg_sqs[i])
+            # Use the max. for normalizing running avg. of gradient
+            denom = max_exp_avg_sqs[i].sqrt().add_(eps)
+        else:
+            denom = exp_avg_sq.sqrt().add_(eps)
+
+        # p - step_size * exp_avg / denom - weight_decay * p
+        if weight_decay != 0:
+            p.mul_(1 - weight_decay)
+        p.addcdiv_(exp_avg, denom, value=step_sizes[i])
+
+
+def _multi_tensor_adamw(params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, step_sizes,
+                        *, beta1, beta2, eps, weight_decay, amsgrad):
+    """ The same as `_single_tensor_adamw`,
+    but each operation is done for all parameters by one (or a few) kernel launch.
+
+    """
+    torch._foreach_mul_(exp_avgs, beta1)
+    torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+    torch._foreach_mul_(exp_avg_sqs, beta2)
+    torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+    if amsgrad:
+        torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+        denom = torch._foreach_sqrt(max_exp_avg_sqs)
+    else:
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+    torch._foreach_add_(denom, eps)
+
+    if weight_decay != 0:
+        torch._foreach_mul_(params, 1 - weight_decay)
+    torch._foreach_addcdiv_(params, exp_avgs, denom, step_sizes)
@@ -94,7 +94,8 @@ class CosineLRWithRestarts():
     def _set_batch_size(self):
         d, r = divmod(self.epoch_size, self.batch_size)
         batches_in_epoch = d + 2 if r > 0 else d + 1
-        self.batch_increment = iter(torch.linspace(0, 1, batches_in_epoch))
+        # python floats so that batch_step doesn't make 0-dim tensors
+        self.batch_increment = iter(torch.linspace(0, 1, batches_in_epoch).tolist())
 
     def step(self):
         self.last_epoch += 1
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Sequence, Dict, Tuple
 
 import librosa
@@ -152,14 +153,18 @@ def calc_snrseg(spec_clean: ndarray, spec_est: ndarray, T_ys: Sequence[int] = (0
 
 
 def calc_using_eval_module(y_clean: ndarray, y_est: ndarray,
-                           T_ys: Sequence[int] = (0,)) -> Dict[str, float]:
+                           T_ys: Sequence[int] = (0,), fs: int = 0) -> Dict[str, float]:
     """ calculate metric using EvalModule. y can be a batch.
 
     :param y_clean:
     :param y_est:
     :param T_ys:
+    :param fs: sampling rate. 0 for hp.fs.
+        This should be given in spawned processes, which don't have the parsed `hp`.
     :return:
     """
+    if not fs:
+        fs = hp.fs
 
     if y_clean.ndim == 1:
         y_clean = y_clean[np.newaxis, ...]
@@ -172,7 +177,7 @@ def calc_using_eval_module(y_clean: ndarray, y_est: ndarray,
         sum_result = None
         for T, item_clean, item_est in zip(T_ys, y_clean, y_est):
             # noinspection PyArgumentList
-            metrics, result = EvalModule(item_clean[:T], item_est[:T], hp.fs)
+            metrics, result = EvalModule(item_clean[:T], item_est[:T], fs)
             result = np.array(result)
             if sum_result is None:
                 sum_result = result
@@ -181,7 +186,7 @@ def calc_using_eval_module(y_clean: ndarray, y_est: ndarray,
         sum_result = sum_result.tolist()
     else:
         # noinspection PyArgumentList
-        metrics, sum_result = EvalModule(y_clean[0, :T_ys[0]], y_est[0, :T_ys[0]], hp.fs)
+        metrics, sum_result = EvalModule(y_clean[0, :T_ys[0]], y_est[0, :T_ys[0]], fs)
 
     return {k: v for k, v in zip(metrics, sum_result)}
 
@@ -242,6 +247,54 @@ def reconstruct_wave(*args: ndarray,
     return wave
 
 
+@lru_cache(maxsize=None)
+def _hann_window(device: torch.device) -> torch.Tensor:
+    """ STFT window of `reconstruct_wave_torch` made once per device
+
+    """
+    return torch.hann_window(hp.n_fft, device=device)
+
+
+def reconstruct_wave_torch(mag: ndarray, phase: ndarray,
+                           n_iter=0, momentum=0., n_sample=-1,
+                           device=None) -> ndarray:
+    """ the same as `reconstruct_wave(mag, phase, ...)`,
+    but griffin-lim is done in `device` using `torch.stft` and `torch.istft`.
+    A batch of spectrograms is reconstructed at once (one stft/istft launch per iteration).
+
+    :param mag: (B x) F x T (x 1)
+    :param phase: initial phase. (B x) F x T (x 1)
+    :param n_iter: no. of iteration of griffin-lim. 0 for not using griffin-lim.
+    :param momentum: fast griffin-lim algorithm momentum
+    :param n_sample: number of time samples of output wave
+    :param device: torch device. default: cpu
+    :return: (B x) n_sample
+    """
+    device = torch.device('cpu' if device is None else device)
+    if mag.shape[-1] == 1:  # channel axis
+        mag = mag[..., 0]
+        phase = phase[..., 0]
+    mag = torch.as_tensor(np.asarray(mag, dtype=np.float32), device=device)
+    phase = torch.as_tensor(np.asarray(phase, dtype=np.float32), device=device)
+    kwargs = dict(n_fft=hp.n_fft, hop_length=hp.l_hop,
+                  window=_hann_window(device), center=True)
+
+    spec = torch.polar(mag, phase)
+    spec_prev = 0
+    for _ in range(n_iter - 1):
+        wave = torch.istft(spec, **kwargs)
+        spec_new = torch.stft(wave, pad_mode='reflect', return_complex=True, **kwargs)
+
+        phase = torch.angle(spec_new - (momentum / (1 + momentum)) * spec_prev)
+        spec = torch.polar(mag, phase)
+        spec_prev = spec_new
+
+    kwarg_len = dict(length=n_sample) if n_sample != -1 else dict()
+    wave = torch.istft(spec, **kwargs, **kwarg_len)
+
+    return wave.cpu().numpy()
+
+
 def draw_spectrogram(data: TensArr, to_db=True, show=False, dpi=150, **kwargs):
     if to_db:
         data[data == 0] = data[data > 0].min()
@@ -264,6 +317,32 @@ def draw_spectrogram(data: TensArr, to_db=True, show=False, dpi=150, **kwargs):
     return fig
 
 
+def spectrogram_to_image(data: TensArr, to_db=True, vmin=None, vmax=None,
+                         cmap='CMRmap') -> ndarray:
+    """ the same colors as `draw_spectrogram` without matplotlib rendering
+    (no axes and colorbar).
+
+    :return: RGB image (F x T x 3, uint8) with low frequency at the bottom
+    """
+    data = convert(data, astype=ndarray)
+    if to_db:
+        data = data.copy()
+        data[data == 0] = data[data > 0].min()
+        data = LogModule.log(data)
+        data *= 20
+    data = data.squeeze()
+
+    if vmin is None:
+        vmin = data.min()
+    if vmax is None:
+        vmax = data.max()
+    idx = (data - vmin) * (255 / max(vmax - vmin, np.finfo(np.float32).tiny))
+    idx = np.clip(idx, 0, 255, out=idx).astype(np.uint8)
+
+    lut = (plt.get_cmap(cmap)(np.arange(256))[:, :3] * 255).astype(np.uint8)  # 256 x 3
+    return lut[idx[::-1]]
+
+
 def cart2sph(x: ndarray, y: ndarray, z: ndarray) -> Tuple[ndarray]:
     hxy = np.hypot(x, y)
     r = np.hypot(hxy, z)
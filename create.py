@@ -22,10 +22,14 @@ More parameters are in `hparams.py`.
 
 import multiprocessing as mp
 import os
+import re
+from collections import OrderedDict
+from multiprocessing import shared_memory
 from argparse import ArgumentParser, ArgumentError
 from pathlib import Path
-from typing import Tuple, TypeVar, Optional, List
+from typing import Dict, List, Optional, Sequence, Tuple, TypeVar
 from dataclasses import dataclass, asdict
+from functools import lru_cache
 from itertools import product as iterprod
 import cupy as cp
 # noinspection PyUnresolvedReferences
@@ -35,13 +39,24 @@ import librosa
 import numpy as np
 import scipy.io as scio
 import scipy.signal as scsig
+from scipy.fft import next_fast_len
 import soundfile as sf
 from tqdm import tqdm
 
-from hparams import hp
+from hparams import hp, PHASE_INT16_SCALE
 
 NDArray = TypeVar('NDArray', np.ndarray, cp.ndarray)
 
+n_plan_cache = 64  # max. no. of cuFFT plans cached per device
+
+# buffers reused across data samples in this process (see `_get_buffer`)
+_buffers: Dict[tuple, NDArray] = dict()
+
+# RIR spectra for each FFT length, least recently used first (see `_get_rirs_fft`)
+# The total size is limited by `max_bytes_rirs_fft` per device.
+max_bytes_rirs_fft = 128 * 2**20
+_rirs_fft: 'OrderedDict[int, cp.ndarray]' = OrderedDict()
+
 
 @dataclass
 class SFTData:
@@ -83,11 +98,70 @@ class SFTData:
         return SFTData(**dict_single)
 
 
-def stft(data: NDArray, _win: NDArray):
+# reflect padding + framing + windowing in one pass (output: n_ch x n_frame x n_fft)
+# frames are read directly from the unpadded wave,
+# so neither the padded wave nor the windowed frames have to be materialized twice.
+# Each row (channel) has its own length `lens[i_ch]` (<= l_row),
+# and the frames beyond the no. of frames of the row are zero.
+_frame_window_kernel = cp.ElementwiseKernel(
+    'raw X data, raw int32 lens, raw float32 _win, int32 l_row, int32 n_frame, '
+    'int32 l_frame, int32 n_fft, int32 l_hop',
+    'Y frame',
+    '''
+    const int k = i % n_fft;
+    const int i_frame = (i / n_fft) % n_frame;
+    const int i_ch = i / (n_fft * n_frame);
+    const int len_data = lens[i_ch];
+    const int n_frame_ch = (len_data + n_fft / 2 * 2 - l_frame) / l_hop + 1;
+    if (k < l_frame && i_frame < n_frame_ch) {
+        int t = i_frame * l_hop + k - n_fft / 2;
+        if (t < 0) {
+            t = -t;
+        } else if (t >= len_data) {
+            t = 2 * (len_data - 1) - t;
+        }
+        frame = (Y)data[i_ch * l_row + t] * _win[k];
+    } else {
+        frame = 0;
+    }
+    ''',
+    'frame_window',
+)
+
+
+def calc_n_frame(len_data: int) -> int:
+    """ no. of frames of `stft` for a signal with the length `len_data`
+
+    """
+    return (len_data + hp.n_fft // 2 * 2 - hp.l_frame) // hp.l_hop + 1
+
+
+def stft(data: NDArray, _win: NDArray, lens: Sequence[int] = None):
     """ This implementation is expected as the same as `librosa.stft`.
 
+    :param data: (n_ch x n)
+    :param _win:
+    :param lens: (only for cupy) length of each row of zero-padded `data`.
+        The STFT of each row is the same as that of `data[i_ch, :lens[i_ch]]`
+        followed by zero frames. default: n for all rows
     """
     xp = cp.get_array_module(data)
+    if xp is cp:
+        data = cp.ascontiguousarray(data)
+        if lens is None:
+            lens = [data.shape[1]] * data.shape[0]
+        n_frame = calc_n_frame(int(max(lens)))
+
+        frames = _get_buffer(('stft_frames',), (data.shape[0], n_frame, hp.n_fft),
+                             cp.result_type(data.dtype, cp.complex64))
+        _frame_window_kernel(data, cp.asarray(np.asarray(lens, dtype=np.int32)),
+                             _win.astype(cp.float32, copy=False),
+                             data.shape[1], n_frame, hp.l_frame, hp.n_fft, hp.l_hop,
+                             frames)
+        spec = cp.fft.fft(frames, axis=-1)[..., :hp.n_freq]  # n_ch x T x F
+
+        return spec.transpose(0, 2, 1)  # n_ch x F x T
+
     data = xp.pad(data,
                   ((0, 0), (hp.n_fft // 2, hp.n_fft // 2)),
                   mode='reflect')
@@ -129,11 +203,17 @@ def filter_overlap_add(wave: NDArray, filter_fft: NDArray, _win: NDArray):
     strided = strided * _win
     strided_filt = xp.fft.ifft(xp.fft.fft(strided, axis=1) * filter_fft, axis=1)
     strided_filt *= _win
-    filtered = xp.zeros((wave.shape[0], len_istft), dtype=xp.complex64)
-    startend = np.array([0, hp.l_frame])
-    for i_frame in range(n_frame):
-        filtered[:, slice(*startend)] += strided_filt[..., i_frame]
-        startend += hp.l_hop
+
+    # overlap-add: the j-th hop-sized segment of every frame is added at once.
+    # filtered is laid out as (n_ch x n_hop_block x l_hop) so that the frame index and
+    # the hop-block index share the same axis.
+    n_overlap = -(-hp.l_frame // hp.l_hop)
+    n_hop_block = max(n_frame + n_overlap - 1, -(-len_istft // hp.l_hop))
+    filtered = xp.zeros((wave.shape[0], n_hop_block, hp.l_hop), dtype=xp.complex64)
+    for j in range(n_overlap):
+        seg = strided_filt[:, j * hp.l_hop:(j + 1) * hp.l_hop, :]  # n_ch x w x n_frame
+        filtered[:, j:j + n_frame, :seg.shape[1]] += seg.transpose(0, 2, 1)
+    filtered = filtered.reshape(wave.shape[0], -1)[:, :len_istft]
 
     # compensate artifact of stft/istft
     # noinspection PyTypeChecker
@@ -152,6 +232,31 @@ def filter_overlap_add(wave: NDArray, filter_fft: NDArray, _win: NDArray):
     return filtered if xp.iscomplexobj(wave) else filtered.real
 
 
+@lru_cache(maxsize=None)
+def _seltriag_index(len_in: int, nrord: int, shft: Tuple[int, int],
+                    xp=np) -> Tuple[NDArray, NDArray]:
+    """ gather index for `seltriag`
+
+    :return: (idx, idx_zero)
+        idx: indices of Ain to be selected (0 for the coefficients that don't exist)
+        idx_zero: indices of Aout that should be zero
+    """
+    N = int(np.ceil(np.sqrt(len_in)) - 1)
+    idx = np.full((N - nrord + 1)**2, -1, dtype=np.int32)
+    i = 0
+    for ii in range(N - nrord + 1):
+        for jj in range(-ii, ii + 1):
+            n, m = shft[0] + ii, shft[1] + jj
+            idx_from = m + n * (n + 1)
+            if -n <= m <= n and 0 <= n <= N and idx_from < len_in:
+                idx[i] = idx_from
+            i += 1
+    idx_zero = np.flatnonzero(idx == -1).astype(np.int32)
+    idx[idx_zero] = 0
+
+    return xp.asarray(idx), xp.asarray(idx_zero)
+
+
 def seltriag(Ain: NDArray, nrord: int, shft: Tuple[int, int]) -> NDArray:
     """ select spherical harmonics coefficients from Ain
         with the maximum order $N$-`nrord`,
@@ -164,22 +269,63 @@ def seltriag(Ain: NDArray, nrord: int, shft: Tuple[int, int]) -> NDArray:
     :return:
     """
     xp = cp.get_array_module(Ain)
-    other_shape = Ain.shape[1:] if Ain.ndim > 1 else tuple()
-    N = int(np.ceil(np.sqrt(Ain.shape[0])) - 1)
-    idx = 0
-    len_new = (N - nrord + 1)**2
+    idx, idx_zero = _seltriag_index(Ain.shape[0], nrord, tuple(shft), xp)
 
-    Aout = xp.zeros((len_new, *other_shape), dtype=Ain.dtype)
-    for ii in range(N - nrord + 1):
-        for jj in range(-ii, ii + 1):
-            n, m = shft[0] + ii, shft[1] + jj
-            idx_from = m + n * (n + 1)
-            if -n <= m <= n and 0 <= n <= N and idx_from < Ain.shape[0]:
-                Aout[idx] = Ain[idx_from]
-            idx += 1
+    Aout = Ain[idx]
+    if len(idx_zero) > 0:
+        Aout[idx_zero] = 0
     return Aout
 
 
+# shft of seltriag for p, v_px_py (2 terms), v_px_ny (2 terms), v_z (2 terms)
+_SHFTS_INTENSITY = ((0, 0), (1, -1), (-1, -1), (-1, 1), (1, 1), (-1, 0), (1, 0))
+
+# gather + multiply + sum over the SH coefficients of `calc_intensity` in one pass
+# Asv: n_hrm x ..., recur_coeffs: 6 x len_new, idxs: 7 x len_new (-1 for zero)
+_intensity_kernel = cp.ElementwiseKernel(
+    'raw T Asv, raw T recur_coeffs, raw int32 idxs, int32 len_new, int32 n_other',
+    'float32 out0, float32 out1, float32 out2',
+    '''
+    float sum0 = 0, sum1 = 0, sum2 = 0;
+    for (int h = 0; h < len_new; h++) {
+        T a[7];
+        for (int s = 0; s < 7; s++) {
+            const int idx = idxs[s * len_new + h];
+            a[s] = idx < 0 ? T(0) : Asv[idx * n_other + i];
+        }
+        const T p_conj = conj(a[0]);
+        const T v_px_py = recur_coeffs[h] * a[1] - recur_coeffs[len_new + h] * a[2];
+        const T v_px_ny = (recur_coeffs[2 * len_new + h] * a[3]
+                           - recur_coeffs[3 * len_new + h] * a[4]);
+        const T v_z = (recur_coeffs[4 * len_new + h] * a[5]
+                       + recur_coeffs[5 * len_new + h] * a[6]);
+        sum0 += (p_conj * (v_px_py + v_px_ny)).real();
+        sum1 += (p_conj * (v_px_py - v_px_ny)).imag();
+        sum2 += (p_conj * v_z).real();
+    }
+    out0 = sum0 / 4;
+    out1 = sum1 / 4;
+    out2 = sum2 / 2;
+    ''',
+    'intensity',
+)
+
+
+@lru_cache(maxsize=None)
+def _intensity_index(len_in: int) -> cp.ndarray:
+    """ gather indices of `_intensity_kernel` (7 x len_new). -1 means zero.
+
+    """
+    idxs = []
+    for shft in _SHFTS_INTENSITY:
+        idx, idx_zero = _seltriag_index(len_in, 1, shft)
+        idx = idx.copy()
+        idx[idx_zero] = -1
+        idxs.append(idx)
+
+    return cp.asarray(np.stack(idxs))
+
+
 def calc_intensity(Asv: NDArray,
                    recur_coeffs: NDArray,
                    out: NDArray = None) -> NDArray:
@@ -195,6 +341,20 @@ def calc_intensity(Asv: NDArray,
     xp = cp.get_array_module(Asv)
     other_shape = Asv.shape[1:]
 
+    if out is None:
+        out = xp.empty((*other_shape, 3), dtype=xp.float32)
+    else:
+        assert out.shape == (*other_shape, 3)
+
+    if xp is cp:
+        idxs = _intensity_index(Asv.shape[0])
+        len_new = idxs.shape[1]
+        _intensity_kernel(cp.ascontiguousarray(Asv),
+                          cp.ascontiguousarray(recur_coeffs, dtype=Asv.dtype),
+                          idxs, len_new, int(np.prod(other_shape)),
+                          out[..., 0], out[..., 1], out[..., 2])
+        return out
+
     p_conj = seltriag(Asv, 1, (0, 0)).conj()
     v_px_py = (recur_coeffs[0] * seltriag(Asv, 1, (1, -1))
                - recur_coeffs[1] * seltriag(Asv, 1, (-1, -1)))
@@ -203,10 +363,6 @@ def calc_intensity(Asv: NDArray,
     v_z = (recur_coeffs[4] * seltriag(Asv, 1, (-1, 0))
            + recur_coeffs[5] * seltriag(Asv, 1, (1, 0)))
 
-    if out is None:
-        out = xp.empty((*other_shape, 3), dtype=xp.float32)
-    else:
-        assert out.shape == (*other_shape, 3)
     (p_conj * (v_px_py + v_px_ny)).real.sum(axis=0, out=out[..., 0])
     (p_conj * (v_px_py - v_px_ny)).imag.sum(axis=0, out=out[..., 1])
     out[..., 0:2] /= 2
@@ -216,9 +372,12 @@ def calc_intensity(Asv: NDArray,
     return out
 
 
+@lru_cache(maxsize=None)
 def calc_mat_for_real_coeffs(N: int) -> np.ndarray:
     """ calculate matrix to convert complex SHD signals to real SHD signals
 
+    The result is cached, so it is read-only.
+
     :param N: n-order
     :return: (n_hrm x n_hrm)
     """
@@ -239,7 +398,23 @@ def calc_mat_for_real_coeffs(N: int) -> np.ndarray:
 
             matrix[idxs[n - 1]:idxs[n], idxs[n - 1]:idxs[n]] = block
 
-    return matrix.conj()
+    matrix = matrix.conj()
+    matrix.flags.writeable = False
+    return matrix
+
+
+# writes the direction vector directly in the layout of (... x 3)
+_direction_vec_kernel = cp.ElementwiseKernel(
+    'T a0, T a3, T a1, T a2',
+    'float32 out0, float32 out1, float32 out2',
+    '''
+    const T a0_conj = conj(a0);
+    out0 = (a0_conj * a3).real() * sqrt(0.5);
+    out1 = (a0_conj * a1).real() * sqrt(0.5);
+    out2 = (a0_conj * a2).real() * sqrt(0.5);
+    ''',
+    'direction_vec',
+)
 
 
 def calc_direction_vec(anm: NDArray, out: NDArray = None) -> NDArray:
@@ -249,6 +424,15 @@ def calc_direction_vec(anm: NDArray, out: NDArray = None) -> NDArray:
     :param out: (... x 3)
     :return: (... x 3)
     """
+    if cp.get_array_module(anm) is cp:
+        if out is None:
+            out = cp.empty((*anm.shape[1:], 3), dtype=cp.float32)
+        else:
+            assert out.shape == (*anm.shape[1:], 3)
+        _direction_vec_kernel(anm[0], anm[3], anm[1], anm[2],
+                              out[..., 0], out[..., 1], out[..., 2])
+        return out
+
     result = (anm[0].conj() * anm[[3, 1, 2]]).real
     result = np.moveaxis(result, 0, -1)
     result *= np.sqrt(0.5)
@@ -262,6 +446,26 @@ def calc_direction_vec(anm: NDArray, out: NDArray = None) -> NDArray:
     return out
 
 
+def quantize_phase(phase: NDArray) -> NDArray:
+    """ phase in [-pi, pi] (float) -> int16
+
+    """
+    xp = cp.get_array_module(phase)
+    return xp.rint(phase * PHASE_INT16_SCALE).astype(xp.int16)
+
+
+# magnitude and quantized phase (the same as `quantize_phase(cp.angle(z))`) in one read of z
+_mag_phase_kernel = cp.ElementwiseKernel(
+    'complex64 z, float32 scale',
+    'float32 mag, int16 phase',
+    '''
+    mag = hypotf(z.real(), z.imag());
+    phase = (short)rintf(atan2f(z.imag(), z.real()) * scale);
+    ''',
+    'mag_phase',
+)
+
+
 # Calculate dirspec or mulspec of data samples in list_feature.
 # This function is only for parallelism, and not related to the algorithm.
 def process():
@@ -274,11 +478,6 @@ def process():
         q_data = [manager.Queue(3) for _ in hp.device]
         q_out = manager.Queue(3 * n_cuda_dev)
 
-        # open speech files
-        speech = []
-        for f_speech in flist_speech:
-            speech.append(sf.read(str(f_speech))[0].astype(np.float32))
-
         # apply extractor first
         # extractor gets data from q_data, and sends the result to q_out
         pool_extractor.starmap_async(
@@ -286,7 +485,8 @@ def process():
             [(dev,
               q_data[idx],
               len(list_feature[idx_start + idx::n_cuda_dev]),
-              q_out)
+              q_out,
+              sorted({i_loc for _, _, i_loc in list_feature[idx_start + idx::n_cuda_dev]}))
              for idx, dev in enumerate(hp.device)]
         )
         pool_extractor.close()
@@ -296,11 +496,10 @@ def process():
         for idx, (i_speech, _, i_loc) in zip(range_feature, list_feature[idx_start:]):
             pool_propagater.apply_async(
                 propagate,
-                (idx, i_speech, flist_speech[i_speech], speech[i_speech], i_loc,
+                (idx, i_speech, flist_speech[i_speech], i_loc,
                  q_data[(idx - idx_start) % n_cuda_dev])
             )
-            # propagate(idx, i_speech, flist_speech[i_speech],
-            #           speech[i_speech], i_loc,
+            # propagate(idx, i_speech, flist_speech[i_speech], i_loc,
             #           q_data[(idx - idx_start) % n_cuda_dev])
         pool_propagater.close()
 
@@ -322,19 +521,97 @@ def process():
     print_save_info(n_feature)
 
 
-def propagate(idx: int, i_speech: int, f_speech: Path,
-              data: np.ndarray, i_loc: int,
+def propagate(idx: int, i_speech: int, f_speech: Path, i_loc: int,
               queue: mp.Queue):
-    # RIR Filtering
-    data_room = scsig.fftconvolve(data[np.newaxis, :], RIRs[i_loc])
+    if 'mulspec' in hp.feature:
+        data = get_speech(i_speech)
 
-    # Propagation (delay and level matching)
-    data = np.append(np.zeros(t_peak[i_loc], dtype=np.float32), data * amp_peak[i_loc])
+        # RIR Filtering
+        data_room = scsig.fftconvolve(data[np.newaxis, :], RIRs[i_loc])
+
+        # Propagation (delay and level matching)
+        data = np.append(np.zeros(t_peak[i_loc], dtype=np.float32), data * amp_peak[i_loc])
+        shared = put_shared(data, data_room)
+    else:  # RIR filtering and propagation are done in the GPU (`calc_dirspecs`)
+        shared = None
 
-    queue.put((idx, i_speech, f_speech, i_loc, data, data_room))
+    queue.put((idx, i_speech, f_speech, i_loc, shared))
 
 
-def calc_dirspecs(i_dev: int, q_data: mp.Queue, n_data: int, q_out: mp.Queue):
+def get_speech(i_speech: int) -> np.ndarray:
+    """ `i_speech`-th speech signal in the shared memory `speech_shm` (not copied)
+
+    """
+    return speech_all[speech_offsets[i_speech]:speech_offsets[i_speech + 1]]
+
+
+def put_shared(*arrays: np.ndarray) -> Tuple[str, List[Tuple]]:
+    """ copy arrays to a new shared memory block to send them to another process.
+    The block is unlinked by `get_shared`.
+
+    :return: (name of the block, list of (shape, dtype, offset))
+    """
+    nbytes_aligned = [-(-a.nbytes // 64) * 64 for a in arrays]  # 64-byte aligned
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(nbytes_aligned), 1))
+    metas = []
+    offset = 0
+    for a, nbytes in zip(arrays, nbytes_aligned):
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[...] = a
+        metas.append((a.shape, a.dtype.str, offset))
+        offset += nbytes
+    shm.close()
+
+    return shm.name, metas
+
+
+def get_shared(name: str, metas: List[Tuple]) -> List[np.ndarray]:
+    """ get arrays sent by `put_shared`, and unlink the shared memory block.
+
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = [np.ndarray(shape, dtype, buffer=shm.buf, offset=offset).copy()
+              for shape, dtype, offset in metas]
+    shm.close()
+    shm.unlink()
+
+    return arrays
+
+
+def _pinned_empty(shape: Tuple[int, ...], dtype) -> np.ndarray:
+    """ page-locked ndarray for asynchronous copies between host and device
+
+    """
+    size = int(np.prod(shape))
+    mem = cp.cuda.alloc_pinned_memory(size * np.dtype(dtype).itemsize)
+    return np.frombuffer(mem, dtype, size).reshape(shape)
+
+
+def _get_buffer(key: tuple, shape: Tuple[int, ...], dtype, pinned=False) -> NDArray:
+    """ view of a buffer that is allocated once and reused for every data sample.
+
+    The buffer is reallocated only when it is smaller than `shape`,
+    so it ends up with the size of the longest data sample.
+    A buffer used for stream-ordered device work only can be shared by consecutive samples,
+    but a buffer read by an asynchronous copy needs a different key per pipeline stage.
+
+    :param key: identifier of the buffer
+    :param shape:
+    :param dtype:
+    :param pinned: page-locked host memory if True, device memory otherwise
+    :return: contiguous array with `shape`
+    """
+    size = int(np.prod(shape))
+    dtype = np.dtype(dtype)
+    key = (pinned, dtype, *key)
+    buf = _buffers.get(key)
+    if buf is None or buf.size < size:
+        buf = _pinned_empty((size,), dtype) if pinned else cp.empty(size, dtype=dtype)
+        _buffers[key] = buf
+    return buf[:size].reshape(shape)
+
+
+def calc_dirspecs(i_dev: int, q_data: mp.Queue, n_data: int, q_out: mp.Queue,
+                  i_locs_dev: Sequence[int]):
     """ create directional spectrogram.
 
     pnm means SHD signal (SFT of multichannel signal)
@@ -348,77 +625,261 @@ def calc_dirspecs(i_dev: int, q_data: mp.Queue, n_data: int, q_out: mp.Queue):
     :param q_data:
     :param n_data:
     :param q_out:
+    :param i_locs_dev: RIR indices of the data samples that this device processes
 
     :return: None
     """
 
     # Ready CUDA
     cp.cuda.Device(i_dev).use()
+    # cuFFT plans are cached per shape (stft & filter_overlap_add of both free-field and room)
+    # so that the plans for the same length of speech are not made again.
+    cp.fft.config.get_plan_cache().set_size(n_plan_cache)
+    # Constants are uploaded once per device because `process` runs one `calc_dirspecs` per device.
     win_cp = cp.array(win)
     Ys_cp = cp.array(Ys)
+    # Only the RIRs used in this device. n_loc_dev, n_mic, len_RIR
+    row_of_loc = np.full(n_loc, -1)  # i_loc -> row of RIRs_cp
+    row_of_loc[i_locs_dev] = np.arange(len(i_locs_dev))
+    RIRs_cp = cp.array(RIRs[i_locs_dev])
     sftdata_cp = SFTData(
         **{k: cp.array(v) for k, v in asdict(sftdata).items() if v is not None}
     )
 
-    for _ in range(n_data):
-        idx, i_speech, f_speech, i_loc, data, data_room = q_data.get()
-        data_cp = cp.array(data)  # n,
-        data_room_cp = cp.array(data_room)  # N_MIC x n
+    # HtoD and DtoH copies are issued in stream_copy
+    # so that they are overlapped with the computation in stream_compute.
+    stream_copy = cp.cuda.Stream(non_blocking=True)
+    stream_compute = cp.cuda.Stream(non_blocking=True)
+
+    # The results of the previous batch: (event of DtoH, [(idx, ...), ...], arrays to keep alive)
+    pending = None
+
+    for i_batch, i_start in enumerate(range(0, n_data, hp.n_batch_dirspec)):
+        n_batch = min(hp.n_batch_dirspec, n_data - i_start)
+        items = [q_data.get()[:4] for _ in range(n_batch)]  # (idx, i_speech, f_speech, i_loc)
+        datas = [get_speech(i_speech) for _, i_speech, _, _ in items]
+        lens = [d.shape[0] for d in datas]
+
+        # The buffers of the input and output are double-buffered
+        # because those of the previous batch are still used by the pending DtoH.
+        i_buf = i_batch % 2
+
+        # HtoD (only the source signals zero-padded to the longest one.
+        # RIRs are already in the device.)
+        data_pinned = _get_buffer(('data', i_buf), (n_batch, max(lens)), np.float32,
+                                  pinned=True)
+        for d, row in zip(datas, data_pinned):
+            row[:d.shape[0]] = d
+            row[d.shape[0]:] = 0
+        data_cp = _get_buffer(('data', i_buf), data_pinned.shape, np.float32)  # K x n
+        data_cp.set(data_pinned, stream=stream_copy)
+        stream_compute.wait_event(stream_copy.record())
+
+        with stream_compute:
+            i_locs = [item[3] for item in items]
+            nfft_conv = calc_nfft_conv(max(lens))
+            RIRs_fft_cp = _get_rirs_fft(RIRs_cp, row_of_loc[i_locs], nfft_conv)
+            outs_cp = _calc_dirspecs_batch(data_cp, lens, i_locs, nfft_conv, RIRs_fft_cp,
+                                           win_cp, Ys_cp, sftdata_cp, i_buf)
+
+        # DtoH
+        stream_copy.wait_event(stream_compute.record())
+        outs = [[_get_buffer(('out', i_buf, k, i), a.shape, a.dtype, pinned=True)
+                 for i, a in enumerate(outs_k_cp)]
+                for k, outs_k_cp in enumerate(outs_cp)]
+        for outs_k_cp, outs_k in zip(outs_cp, outs):
+            for a_cp, a in zip(outs_k_cp, outs_k):
+                a_cp.get(out=a, stream=stream_copy)
+
+        # Save the previous results while these results are being copied.
+        if pending:
+            _put_dirspecs(q_out, *pending)
+        pending = (stream_copy.record(),
+                   [(*item, *outs_k) for item, outs_k in zip(items, outs)],
+                   (data_pinned, data_cp, outs_cp))
+
+    if pending:
+        _put_dirspecs(q_out, *pending)
+
+
+def calc_nfft_conv(len_data: int) -> int:
+    """ FFT length for RIR filtering of source signals not longer than `len_data`.
+
+    The length is rounded up to one of 4 classes per octave (at most 19% longer),
+    so that the RIR spectra and cuFFT plans of a length class are reused by the other lengths.
+    """
+    n = len_data + len_RIR - 1
+    return next_fast_len(int(np.ceil(2**(np.ceil(4 * np.log2(n)) / 4))))
 
-        # Free-field
-        # n_hrm, n
-        anm_time_cp = cp.outer(Ys_cp[i_loc].conj(), data_cp)  # complex coefficients
-        if use_dv:  # real coefficients
-            anm_time_cp = (sftdata_cp.T_real @ anm_time_cp).real
-
-        anm_spec_cp = stft(anm_time_cp, win_cp)  # n_hrm x F x T
-
-        # F x T x 4
-        dirspec_free_cp = cp.empty((hp.n_freq, anm_spec_cp.shape[2], 4),
-                                   dtype=cp.float32)
-        if use_dv:
-            calc_direction_vec(anm_spec_cp, out=dirspec_free_cp[..., :3])
-        else:
-            calc_intensity(anm_spec_cp, sftdata_cp.recur_coeffs,
-                           out=dirspec_free_cp[..., :3])
-        cp.abs(anm_spec_cp[0], out=dirspec_free_cp[..., 3])
-        phase_free_cp = cp.angle(anm_spec_cp[0])  # F x T
 
-        # Room
-        pnm_time_cp = sftdata_cp.Yenc @ data_room_cp  # n_hrm x n
-        # n_hrm x F x T
-        if use_dv:  # real coefficients
-            # bnkr equalization in frequency domain
-            anm_time_cp = filter_overlap_add(pnm_time_cp,
-                                             sftdata_cp.bnkr_inv[..., 0],
-                                             win_cp)
-            anm_t_real_cp = (sftdata_cp.T_real @ anm_time_cp).real
-            anm_spec_cp = stft(anm_t_real_cp, win_cp)
-        else:  # complex coefficients
-            pnm_spec_cp = stft(pnm_time_cp, win_cp)
-            anm_spec_cp = pnm_spec_cp * sftdata_cp.bnkr_inv[:, :hp.n_freq]
-
-        # F x T x 4
-        dirspec_room_cp = cp.empty((hp.n_freq, anm_spec_cp.shape[2], 4),
-                                   dtype=cp.float32)
-        if use_dv:
-            calc_direction_vec(anm_spec_cp, out=dirspec_room_cp[..., :3])
-        else:
-            calc_intensity(anm_spec_cp, sftdata_cp.recur_coeffs,
-                           out=dirspec_room_cp[..., :3])
-        cp.abs(anm_spec_cp[0], out=dirspec_room_cp[..., 3])
-        phase_room_cp = cp.angle(anm_spec_cp[0])  # F x T
+def _get_rirs_fft(RIRs_cp: cp.ndarray, rows: np.ndarray, nfft: int) -> cp.ndarray:
+    """ rfft of `RIRs_cp[rows]` with the length `nfft` (len(rows) x n_mic x nfft // 2 + 1)
+
+    The spectra of all `RIRs_cp` are cached for each `nfft` if they fit `max_bytes_rirs_fft`,
+    otherwise the spectra of `rows` only are calculated.
+    """
+    nbytes = RIRs_cp.shape[0] * RIRs_cp.shape[1] * (nfft // 2 + 1) * 8  # complex64
+    if nbytes > max_bytes_rirs_fft:
+        return cp.fft.rfft(RIRs_cp[cp.asarray(rows)], n=nfft)
+
+    if nfft in _rirs_fft:
+        _rirs_fft.move_to_end(nfft)
+    else:
+        while _rirs_fft and sum(a.nbytes for a in _rirs_fft.values()) + nbytes > max_bytes_rirs_fft:
+            _rirs_fft.popitem(last=False)
+        _rirs_fft[nfft] = cp.fft.rfft(RIRs_cp, n=nfft)
+    return _rirs_fft[nfft][cp.asarray(rows)]
+
+
+def _put_dirspecs(q_out: mp.Queue, event: cp.cuda.Event, results: List[tuple], _: tuple):
+    """ wait until the DtoH copy of `calc_dirspecs` ends, and send the results to q_out
+
+    """
+    event.synchronize()
+    for result in results:
+        idx, i_speech, f_speech, i_loc, dirspec_free, dirspec_room, phase_free, phase_room \
+            = result
 
         # Save (F x T x C)
         dict_result = dict(path_speech=str(f_speech),
-                           dirspec_free=cp.asnumpy(dirspec_free_cp),
-                           dirspec_room=cp.asnumpy(dirspec_room_cp),
-                           phase_free_cp=cp.asnumpy(phase_free_cp)[..., np.newaxis],
-                           phase_room_cp=cp.asnumpy(phase_room_cp)[..., np.newaxis],
+                           dirspec_free=dirspec_free,
+                           dirspec_room=dirspec_room,
+                           phase_free_cp=phase_free[..., np.newaxis],
+                           phase_room_cp=phase_room[..., np.newaxis],
                            )
         q_out.put((idx, i_speech, i_loc, dict_result))
 
 
+def _unbatch(a_batch: cp.ndarray, n_frames: Sequence[int], key: str, i_buf: int,
+             dtype=None) -> List[cp.ndarray]:
+    """ contiguous (reused) copy of each data sample of `a_batch` (K x F x T_max x ...)
+        with its own no. of frames
+
+    """
+    if dtype is None:
+        dtype = a_batch.dtype
+    result = []
+    for k, n_frame in enumerate(n_frames):
+        a = _get_buffer((key, i_buf, k), (a_batch.shape[1], n_frame, *a_batch.shape[3:]),
+                        dtype)
+        a[...] = a_batch[k, :, :n_frame]
+        result.append(a)
+    return result
+
+
+def _calc_dirspecs_batch(data_cp: cp.ndarray, lens: Sequence[int], i_locs: Sequence[int],
+                         nfft_conv: int, RIRs_fft_cp: cp.ndarray,
+                         win_cp: cp.ndarray, Ys_cp: cp.ndarray,
+                         sftdata_cp: SFTData, i_buf: int) -> List[Tuple[cp.ndarray, ...]]:
+    """ directional spectrograms of a batch of data samples
+
+    All samples in the batch are filtered, transformed, and analyzed by the same kernel launches.
+    The result of each sample is the same as that of the sample alone.
+
+    :param data_cp: source signals zero-padded to the longest one (K x n)
+    :param lens: length of each source signal
+    :param i_locs: RIR index of each source signal
+    :param nfft_conv: FFT length for RIR filtering (see `calc_nfft_conv`)
+    :param RIRs_fft_cp: rfft of the RIR of each source signal with the length of `nfft_conv`
+        (K x n_mic x nfft_conv // 2 + 1)
+    :param i_buf: index of the output buffers (see `_get_buffer`)
+    :return: [(dirspec_free_cp, dirspec_room_cp, phase_free_cp, phase_room_cp), ...]
+    """
+    n_batch = data_cp.shape[0]
+    n_hrm = Ys_cp.shape[1]
+    lens = np.asarray(lens)
+    i_locs = np.asarray(i_locs)
+    lens_free = t_peak[i_locs] + lens
+    lens_room = lens + len_RIR - 1
+    n_frames_free = [calc_n_frame(int(n)) for n in lens_free]
+    n_frames_room = [calc_n_frame(int(n)) for n in lens_room]
+    dtype_dirspec = cp.float16 if hp.fp16_dirspec else cp.float32
+
+    # RIR Filtering
+    # K x N_MIC x n
+    data_fft_cp = cp.fft.rfft(data_cp, n=nfft_conv)
+    i_locs_cp = cp.asarray(i_locs)
+    data_room_cp = cp.fft.irfft(data_fft_cp[:, cp.newaxis] * RIRs_fft_cp, n=nfft_conv)
+    data_room_cp = data_room_cp[..., :lens_room.max()]
+
+    # Propagation (delay and level matching)
+    data_delayed_cp = _get_buffer(('data_delayed',), (n_batch, lens_free.max()), cp.float32)
+    data_delayed_cp[...] = 0
+    for k, (len_data, i_loc) in enumerate(zip(lens, i_locs)):
+        cp.multiply(data_cp[k, :len_data], amp_peak[i_loc],
+                    out=data_delayed_cp[k, t_peak[i_loc]:t_peak[i_loc] + len_data])
+
+    # Free-field
+    # K x n_hrm x n
+    anm_time_cp = cp.multiply(Ys_cp[i_locs_cp].conj()[..., cp.newaxis],
+                              data_delayed_cp[:, cp.newaxis],
+                              out=_get_buffer(('anm_time',),
+                                              (n_batch, n_hrm, data_delayed_cp.shape[1]),
+                                              cp.complex64))  # complex coefficients
+    if use_dv:  # real coefficients
+        anm_time_cp = (sftdata_cp.T_real @ anm_time_cp).real
+
+    anm_spec_cp = _stft_batch(anm_time_cp, win_cp, lens_free)  # n_hrm x K x F x T
+
+    # K x F x T x 4
+    dirspec_free_cp = _get_buffer(('dirspec_free',), (*anm_spec_cp.shape[1:], 4), cp.float32)
+    if use_dv:
+        calc_direction_vec(anm_spec_cp, out=dirspec_free_cp[..., :3])
+    else:
+        calc_intensity(anm_spec_cp, sftdata_cp.recur_coeffs,
+                       out=dirspec_free_cp[..., :3])
+    phase_free_cp = _get_buffer(('phase_free',), anm_spec_cp.shape[1:], cp.int16)  # K x F x T
+    _mag_phase_kernel(anm_spec_cp[0], np.float32(PHASE_INT16_SCALE),
+                      dirspec_free_cp[..., 3], phase_free_cp)
+
+    # quantization and split into samples before DtoH
+    dirspec_free_cp = _unbatch(dirspec_free_cp, n_frames_free, 'dirspec_free', i_buf,
+                               dtype_dirspec)
+    phase_free_cp = _unbatch(phase_free_cp, n_frames_free, 'phase_free', i_buf)
+
+    # Room
+    pnm_time_cp = sftdata_cp.Yenc @ data_room_cp  # K x n_hrm x n
+    # n_hrm x K x F x T
+    if use_dv:  # real coefficients
+        # bnkr equalization in frequency domain
+        anm_time_cp = cp.zeros_like(pnm_time_cp)
+        for k, len_room in enumerate(lens_room):
+            anm_time_cp[k, :, :len_room] = filter_overlap_add(pnm_time_cp[k, :, :len_room],
+                                                              sftdata_cp.bnkr_inv[..., 0],
+                                                              win_cp)
+        anm_t_real_cp = (sftdata_cp.T_real @ anm_time_cp).real
+        anm_spec_cp = _stft_batch(anm_t_real_cp, win_cp, lens_room)
+    else:  # complex coefficients
+        pnm_spec_cp = _stft_batch(pnm_time_cp, win_cp, lens_room)
+        anm_spec_cp = pnm_spec_cp * sftdata_cp.bnkr_inv[:, cp.newaxis, :hp.n_freq]
+
+    # K x F x T x 4
+    dirspec_room_cp = _get_buffer(('dirspec_room',), (*anm_spec_cp.shape[1:], 4), cp.float32)
+    if use_dv:
+        calc_direction_vec(anm_spec_cp, out=dirspec_room_cp[..., :3])
+    else:
+        calc_intensity(anm_spec_cp, sftdata_cp.recur_coeffs,
+                       out=dirspec_room_cp[..., :3])
+    phase_room_cp = _get_buffer(('phase_room',), anm_spec_cp.shape[1:], cp.int16)  # K x F x T
+    _mag_phase_kernel(anm_spec_cp[0], np.float32(PHASE_INT16_SCALE),
+                      dirspec_room_cp[..., 3], phase_room_cp)
+
+    dirspec_room_cp = _unbatch(dirspec_room_cp, n_frames_room, 'dirspec_room', i_buf,
+                               dtype_dirspec)
+    phase_room_cp = _unbatch(phase_room_cp, n_frames_room, 'phase_room', i_buf)
+
+    return list(zip(dirspec_free_cp, dirspec_room_cp, phase_free_cp, phase_room_cp))
+
+
+def _stft_batch(data_cp: cp.ndarray, win_cp: cp.ndarray, lens: Sequence[int]) -> cp.ndarray:
+    """ `stft` of zero-padded multichannel signals (K x n_ch x n) -> n_ch x K x F x T
+
+    """
+    n_batch, n_ch, len_max = data_cp.shape
+    spec = stft(data_cp.reshape(n_batch * n_ch, len_max), win_cp, np.repeat(lens, n_ch))
+    return spec.reshape(n_batch, n_ch, *spec.shape[1:]).swapaxes(0, 1)
+
+
 def calc_specs(i_dev: int, q_data: mp.Queue, n_data: int, q_out: mp.Queue):
     """ create spectrograms.
 
@@ -431,7 +892,8 @@ def calc_specs(i_dev: int, q_data: mp.Queue, n_data: int, q_out: mp.Queue):
     """
 
     for _ in range(n_data):
-        idx, i_speech, f_speech, i_loc, data, data_room = q_data.get()
+        idx, i_speech, f_speech, i_loc, shared = q_data.get()
+        data, data_room = get_shared(*shared)
 
         # Free-field
         data = np.asfortranarray((Ys[i_loc][0] * data).real)
@@ -509,15 +971,21 @@ def list_feature_to_fname(list_feature: List[Tuple]) -> List[str]:
     ]
 
 
+# idx, (i_speech), room, (i_loc)
+_re_fname = re.compile(r'^\d+_(\d+)_[^_\n]*_(\d+)(?:\.npz)?[^\S\n]*$', re.MULTILINE)
+
+
 # list of 00000_0000_room1_00.npz --> list of (0, 0, room1, 0)
 def list_fname_to_feature(list_fname: List[str]) -> List[Tuple]:
-    list_feature = []
-    for f in list_fname:
-        f = f.rstrip().rstrip('.npz')
-        _, i_speech, _, i_loc = f.split('_')
-        if int(i_loc) < n_loc:
-            list_feature.append((int(i_speech), hp.room_create, int(i_loc)))
-    return list_feature
+    # all file names are parsed at once
+    list_fname = np.atleast_1d(list_fname)
+    matches = _re_fname.findall('\n'.join(list_fname))
+    if len(matches) != len(list_fname):
+        raise ValueError(f'{len(list_fname) - len(matches)} of the file names '
+                         f'are not in the form of "{hp.form_feature}".')
+    i_speech_loc = np.array(matches, dtype=np.int64).reshape(-1, 2)
+    i_speech_loc = i_speech_loc[i_speech_loc[:, 1] < n_loc]
+    return [(i_speech, hp.room_create, i_loc) for i_speech, i_loc in i_speech_loc.tolist()]
 
 
 if __name__ == '__main__':
@@ -650,6 +1118,7 @@ if __name__ == '__main__':
     if n_feature < args.from_idx:
         raise ArgumentError
 
+
     # The index of the first speech file that have to be processed
     idx_exist = -2  # -2 means all files already exist
     for idx, tup in enumerate(list_feature):
@@ -677,4 +1146,21 @@ if __name__ == '__main__':
             elif ans.lower() == 'n':
                 exit(0)
 
-    process()
+    # open speech files
+    # All speech signals are in one shared memory block,
+    # so the subprocesses (forked after this) can read them without pickling.
+    speech = [sf.read(str(f_speech))[0].astype(np.float32) for f_speech in flist_speech]
+    speech_offsets = np.cumsum([0] + [len(item) for item in speech])
+    speech_shm = shared_memory.SharedMemory(create=True,
+                                            size=max(int(speech_offsets[-1]) * 4, 1))
+    speech_all = np.ndarray((speech_offsets[-1],), np.float32, buffer=speech_shm.buf)
+    for i_speech, item in enumerate(speech):
+        speech_all[speech_offsets[i_speech]:speech_offsets[i_speech + 1]] = item
+    del speech
+
+    try:
+        process()
+    finally:
+        del speech_all
+        speech_shm.close()
+        speech_shm.unlink()
@@ -1,25 +1,60 @@
 import multiprocessing as mp
 from copy import copy
+from functools import reduce
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Sequence, Tuple, TypeVar, Union, Optional
 
 import numpy as np
 import scipy.io as scio
 import torch
+try:
+    from numba import njit
+except ImportError:  # numba is optional. NumPy reductions are used instead.
+    njit = None
 from numpy import ndarray
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-from utils import DataPerDevice, TensArr
+from utils import DataPerDevice, TensArr, load_npz_mmap
 from audio_utils import LogModule
-from hparams import Channel, hp
+from hparams import Channel, hp, PHASE_INT16_SCALE
 
 StrOrSeq = TypeVar('StrOrSeq', str, Sequence[str])
 TupOrSeq = TypeVar('TupOrSeq', tuple, Sequence[tuple])
 DataDict = Dict[str, Any]
 
 
+if njit:
+    # Not parallel=True because each worker of the pool in `Normalization.calc_const`
+    # already runs this for a different file.
+    # Not cache=True because the cache is written next to this file, which can be read-only.
+    # (This is compiled in a moment.)
+    @njit
+    def _mean_m2_axis1(a: ndarray) -> Tuple[ndarray, ndarray]:
+        """ mean and sum of squared deviation along axis 1 of F x T x C array (float64 acc.)
+
+        """
+        F, T, C = a.shape
+        mean = np.empty((F, 1, C), np.float64)
+        m2 = np.empty((F, 1, C), np.float64)
+        for i in range(F):
+            for c in range(C):
+                s = 0.
+                for t in range(T):
+                    s += a[i, t, c]
+                m = s / T
+                s = 0.
+                for t in range(T):
+                    d = a[i, t, c] - m
+                    s += d * d
+                mean[i, 0, c] = m
+                m2[i, 0, c] = s
+        return mean, m2
+else:
+    _mean_m2_axis1 = None
+
+
 def xy_signature(func):
     def wrapper(self, *args, **kwargs):
         assert (len(args) > 0) ^ (len(kwargs) > 0)
@@ -46,41 +81,48 @@ class Normalization:
     """
 
     @staticmethod
-    def _sum(a: ndarray) -> ndarray:
-        return LogModule.log_(a).sum(axis=1, keepdims=True)
+    def _count_mean_m2(a: ndarray) -> Tuple[int, ndarray, ndarray]:
+        """ no. of frames, mean, and sum of squared deviation with respect to time axis
 
-    @staticmethod
-    def _sq_dev(a: ndarray, mean_a: ndarray) -> ndarray:
-        return ((LogModule.log_(a) - mean_a)**2).sum(axis=1, keepdims=True)
+        """
+        a = LogModule.log(a)
+        if _mean_m2_axis1 and a.ndim == 3:
+            mean_a, m2_a = _mean_m2_axis1(a)
+        else:
+            mean_a = a.mean(axis=1, keepdims=True, dtype=np.float64)
+            m2_a = ((a - mean_a)**2).sum(axis=1, keepdims=True)
+        return a.shape[1], mean_a, m2_a
 
     @staticmethod
-    def _load_data(fname: Union[str, Path], key: str, n_channels: int, queue: mp.Queue) -> None:
-        x = np.load(fname, mmap_mode='r')[key].astype(np.float32, copy=False)
-        if n_channels != 0:
-            x = x[..., :n_channels]
-        queue.put(x)
+    def _merge_mean_m2(result_a: Tuple[int, ndarray, ndarray],
+                       result_b: Tuple[int, ndarray, ndarray]) -> Tuple[int, ndarray, ndarray]:
+        """ merge two results of `_count_mean_m2` (Chan's parallel algorithm)
 
-    @staticmethod
-    def _calc_per_data(data,
-                       list_func: Sequence[Callable],
-                       args: Sequence = None,
-                       ) -> Dict[Callable, Any]:
-        """ gather return values of functions in `list_func`
-
-        :param list_func:
-        :param args:
-        :return:
         """
+        n_a, mean_a, m2_a = result_a
+        n_b, mean_b, m2_b = result_b
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * (n_b / n)
+        m2 = m2_a + m2_b + delta**2 * (n_a * n_b / n)
+        return n, mean, m2
 
-        if args:
-            result = {f: f(data, arg) for f, arg in zip(list_func, args)}
-        else:
-            result = {f: f(data) for f in list_func}
-        return result
+    @classmethod
+    def _calc_per_file(cls, fname: Union[str, Path], key: str,
+                       n_channels: int) -> Tuple[int, ndarray, ndarray]:
+        """ `_count_mean_m2` of the data in the file. The data is memory-mapped.
+
+        """
+        x = np.asarray(load_npz_mmap(fname, key)).astype(np.float32, copy=False)
+        if n_channels != 0:
+            x = x[..., :n_channels]
+        return cls._count_mean_m2(x)
 
     def __init__(self, mean, std):
         self.mean = DataPerDevice(mean.astype(np.float32, copy=False))
         self.std = DataPerDevice(std.astype(np.float32, copy=False))
+        # 2 * std, made once (per device) rather than in every (de)normalization
+        self.scale = DataPerDevice(2 * self.std[ndarray])
 
     @classmethod
     def calc_const(cls, all_files: List[Path], key: str, n_channels=0):
@@ -92,51 +134,20 @@ class Normalization:
         :rtype: Normalization
         """
 
-        # Calculate summation & size (parallel)
-        list_fn = (np.size, cls._sum)
-        pool_loader = mp.Pool(hp.num_workers)
-        pool_calc = mp.Pool(min(mp.cpu_count() - hp.num_workers - 1, 6))
-        with mp.Manager() as manager:
-            queue_data = manager.Queue()
-            pool_loader.starmap_async(cls._load_data,
-                                      [(f, key, n_channels, queue_data) for f in all_files])
-            result: List[mp.pool.AsyncResult] = []
-            for _ in tqdm(range(len(all_files)), desc='mean', dynamic_ncols=True):
-                data = queue_data.get()
-                result.append(pool_calc.apply_async(
-                    cls._calc_per_data,
-                    (data, list_fn)
-                ))
-
-        result: List[Dict] = [item.get() for item in result]
-
-        sum_size = np.sum([item[np.size] for item in result])
-        sum_ = np.sum([item[cls._sum] for item in result],
-                      axis=0, dtype=np.float32)
-        mean = sum_ / (sum_size // sum_.size)
-
-        # Calculate squared deviation (parallel)
-        with mp.Manager() as manager:
-            queue_data = manager.Queue()
-            pool_loader.starmap_async(cls._load_data,
-                                      [(f, key, n_channels, queue_data) for f in all_files])
-            result: List[mp.pool.AsyncResult] = []
-            for _ in tqdm(range(len(all_files)), desc='std', dynamic_ncols=True):
-                data = queue_data.get()
-                result.append(pool_calc.apply_async(
-                    cls._calc_per_data,
-                    (data, (cls._sq_dev,), (mean,))
-                ))
-
-        pool_loader.close()
-        pool_calc.close()
-        result: List[Dict] = [item.get() for item in result]
+        # Calculate no. of frames, mean & squared deviation in a single pass (parallel)
+        # Only these small results are sent back from the worker.
+        n_workers = hp.num_workers + min(mp.cpu_count() - hp.num_workers - 1, 6)
+        with mp.Pool(n_workers) as pool:
+            result = [pool.apply_async(cls._calc_per_file, (f, key, n_channels))
+                      for f in all_files]
+            result: List[Tuple] = [
+                item.get() for item in tqdm(result, desc='mean, std', dynamic_ncols=True)
+            ]
         print()
 
-        sum_sq_dev = np.sum([item[cls._sq_dev] for item in result],
-                            axis=0, dtype=np.float32)
+        n_frames, mean, sum_sq_dev = reduce(cls._merge_mean_m2, result)
 
-        std = np.sqrt(sum_sq_dev / (sum_size // sum_sq_dev.size) + 1e-5)
+        std = np.sqrt(sum_sq_dev / n_frames + 1e-5)
 
         return cls(mean, std)
 
@@ -146,20 +157,20 @@ class Normalization:
     # normalize and denormalize functions can accept a ndarray or a tensor.
     def normalize(self, a: TensArr) -> TensArr:
         return ((a - self.mean.get_like(a)[..., -a.shape[-1]:])
-                / (2 * self.std.get_like(a)[..., -a.shape[-1]:]))
+                / self.scale.get_like(a)[..., -a.shape[-1]:])
 
     def normalize_(self, a: TensArr) -> TensArr:  # in-place version
         a -= self.mean.get_like(a)[..., -a.shape[-1]:]
-        a /= 2 * self.std.get_like(a)[..., -a.shape[-1]:]
+        a /= self.scale.get_like(a)[..., -a.shape[-1]:]
 
         return a
 
     def denormalize(self, a: TensArr) -> TensArr:
-        return (a * (2 * self.std.get_like(a)[..., -a.shape[-1]:])
+        return (a * self.scale.get_like(a)[..., -a.shape[-1]:]
                 + self.mean.get_like(a)[..., -a.shape[-1]:])
 
     def denormalize_(self, a: TensArr) -> TensArr:  # in-place version
-        a *= 2 * self.std.get_like(a)[..., -a.shape[-1]:]
+        a *= self.scale.get_like(a)[..., -a.shape[-1]:]
         a += self.mean.get_like(a)[..., -a.shape[-1]:]
 
         return a
@@ -259,6 +270,8 @@ class DirSpecDataset(Dataset):
                         sample[k] = data.item()
                     else:
                         data = data[..., v.value]
+                        if data.dtype == np.int16:  # quantized phase
+                            data = data * np.float32(1 / PHASE_INT16_SCALE)
 
                         sample[k] = torch.from_numpy(
                             data.astype(np.float32, copy=False)
@@ -463,6 +476,7 @@ class DirSpecDataset(Dataset):
 
         all_files = dataset._all_files
         metadata = scio.loadmat(dataset._PATH / 'metadata.mat',
+                                variable_names=('n_loc', 'rooms'),
                                 squeeze_me=True,
                                 chars_as_strings=True)
         array_n_loc = metadata['n_loc']
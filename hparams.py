@@ -8,7 +8,6 @@ import numpy as np
 # noinspection PyCompatibility
 from dataclasses import asdict, dataclass, field
 from numpy import ndarray
-import scipy.io as scio
 
 
 # noinspection PyArgumentList
@@ -17,6 +16,10 @@ class Channel(Enum):
     LAST = slice(-1, None)
     NONE = None
 
+# phase in [-pi, pi] is saved as int16 in feature files (phase * PHASE_INT16_SCALE)
+PHASE_INT16_SCALE = 32767 / np.pi
+
+
 # The instance of this class is fully initialized after its `parse_argument` method is called.
 @dataclass
 class _HyperParameters:
@@ -24,6 +27,12 @@ class _HyperParameters:
     device: Union[int, str, Sequence[str], Sequence[int]] = (0, 1, 2, 3)  # GPU idx or 'cpu'
     out_device: Union[int, str] = 2  # The output of the DNN is gathered into this device.
     num_workers: int = 4  # No. of DataLoader workers
+    num_eval_workers: int = 2  # No. of processes calculating PESQ, STOI, fwSegSNR
+    # DistributedDataParallel is used instead of DataParallel if launched by torchrun
+    # (`torchrun --nproc_per_node=N main.py --train`). These are set by the environment variables.
+    rank: int = 0
+    local_rank: int = -1  # -1 for not using DistributedDataParallel
+    world_size: int = 1
 
     # -- select dataset --
     feature: str = 'SIV'  # SIV (also used for Single model)
@@ -45,6 +54,13 @@ class _HyperParameters:
     n_data_per_room: int = 23 * 300  # 20 train RIRs + 3 valid RIRs
     n_test_per_room: int = 10 * 100  # 10 test RIRs
 
+    # If True, directional features are saved as float16 (half of the disk space).
+    # Note that the direction part smaller than 6e-8 becomes zero.
+    fp16_dirspec: bool = False
+
+    # no. of data samples processed together in a GPU for creating directional spectrograms
+    n_batch_dirspec: int = 4
+
     # idx of mics in eigenmike. This starts from 0.
     # In the eigenmike spec sheet, the idx starts from 1.
     chs_mulspec4: Tuple[int] = (5, 6, 20, 21)
@@ -69,9 +85,18 @@ class _HyperParameters:
     n_epochs: int = 60
 
     batch_size: int = 16
+    grad_accum_steps: int = 1  # The optimizer steps once per `grad_accum_steps` batches.
     learning_rate: float = 5e-4
     weight_decay: float = 1e-4  # Adam or AdamW weight_decay
     threshold_stop: float = 0.99  # for early stopping criterion. this is not used by default.
+    # If True, bfloat16 autocast & channels_last are used in the GPUs with compute capability >= 8.
+    # Note that this is on by default, so the results (also of --test) differ from float32 ones.
+    # Set False to reproduce the results of float32 models.
+    use_amp: bool = True
+    # If True (and `use_amp`), float16 autocast with loss scaling is used for compute capability 7.x
+    use_amp_fp16: bool = False
+    compile_model: bool = False  # If True, the model is compiled by `torch.compile` (PyTorch>=2.0)
+    compile_mode: str = 'default'  # `mode` of torch.compile. 'reduce-overhead' uses CUDA graphs.
 
     # -- reconstruction --
     n_gla_iter: int = 20  # 0 for not using Griffin-Lim
@@ -83,8 +108,10 @@ class _HyperParameters:
 
     # -- summary --
     period_save_state: int = 4  # period to save DNN model (unit: epoch)
+    period_print: int = 10  # period to update the loss in the progress bar (unit: iteration)
     eval_with_y_ph: bool = False  # If True, evaluation is proceeded with true (anechoic) phase.
     draw_test_fig: bool = False  # If True, the spectrogram of test data is drawn in tensorboard.
+    use_matplotlib_fig: bool = False  # If True, spectrograms are added as matplotlib figures.
     add_test_audio: bool = True  # If True, time-domain audio of test data is added to tensorboard.
 
     # No. of test data to save hidden block outputs.
@@ -135,8 +162,12 @@ class _HyperParameters:
         # ch_base: The no. of filter of the first block.
         #          2*ch_base for the second block, 4*ch_base for the third...
         # depth: no. of blocks in encoder path.
+        # use_checkpoint: If True, activation checkpointing is used for down/up blocks
+        #                 (less memory, more computation).
+        #                 BatchNorm running stats are updated again in the recomputation.
         self.UNet = dict(ch_base=64,
                          depth=4,
+                         use_checkpoint=False,
                          )
 
         # Read "adamwr/README.md"
@@ -156,6 +187,11 @@ class _HyperParameters:
 
     def init_dependent_vars(self):
         self.logdir = Path(self.logdir)
+        if 'LOCAL_RANK' in os.environ:  # torchrun
+            self.rank = int(os.environ['RANK'])
+            self.local_rank = int(os.environ['LOCAL_RANK'])
+            self.world_size = int(os.environ['WORLD_SIZE'])
+
         # nn
         if self.channels['x'] == Channel.ALL:
             if self.feature == 'mulspec':
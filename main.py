@@ -29,15 +29,16 @@ More parameters are in `hparams.py`.
 - MAX_EPOCH: maximum epoch
 - START_EPOCH: start epoch (Default: -1)
 - DEVICES, OUT_DEVICE, B, LR, WD: read `hparams.py`.
-"""
-# noinspection PyUnresolvedReferences
-import matlab.engine
 
+For multi-GPU training with DistributedDataParallel (one process per GPU),
+launch by `torchrun --nproc_per_node=N main.py --train ...`.
+"""
 import os
 import shutil
 from argparse import ArgumentError, ArgumentParser
 
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, DistributedSampler
 
 from dataset import DirSpecDataset
 from hparams import hp
@@ -76,9 +77,15 @@ if args.num_threads > 0:
         os.environ[var] = str(args.num_threads)
         # os.environ[var] = str(12)
 
+# The no. of frames differs by batch. Expandable segments of the CUDA caching allocator
+# (PyTorch>=2.1) avoid the fragmentation by the variable-size blocks.
+# This is read at the first CUDA allocation, so it is set before `Trainer` is made.
+if hp.device != 'cpu' and tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 # directory
 logdir_train = hp.logdir / 'train'
-if (args.train and args.epoch == -1
+if (args.train and args.epoch == -1 and hp.rank == 0
     and logdir_train.exists() and list(logdir_train.glob(tfevents_fname))):
     # ask if overwrite
     ans = input(form_overwrite_msg.format(logdir_train))
@@ -139,18 +146,35 @@ dataset_train, dataset_valid = DirSpecDataset.split(dataset_temp, (hp.train_rati
 dataset_train.set_needs(**(hp.channels if not args.save else hp.channels_w_ph))
 dataset_valid.set_needs(**hp.channels_w_ph)
 
+# pinned batches are copied asynchronously (see `Trainer.preprocess`)
+kwargs_loader = dict(pin_memory=(hp.device != 'cpu'))
+if hp.num_workers > 0:
+    kwargs_loader.update(persistent_workers=True, prefetch_factor=4)
+
+# DDP: each process loads its own shard with `hp.batch_size / hp.world_size` samples per batch.
+if hp.local_rank >= 0:
+    if hp.batch_size % hp.world_size != 0:
+        raise ValueError(f'batch_size ({hp.batch_size}) should be divisible by '
+                         f'the no. of processes ({hp.world_size}).')
+    kwargs_sampler = dict(
+        batch_size=hp.batch_size // hp.world_size,
+        sampler=DistributedSampler(dataset_train, hp.world_size, hp.rank,
+                                   shuffle=(not args.save)),
+    )
+else:
+    kwargs_sampler = dict(batch_size=hp.batch_size, shuffle=(not args.save))
+
 loader_train = DataLoader(dataset_train,
-                          batch_size=hp.batch_size,
                           num_workers=hp.num_workers,
                           collate_fn=dataset_train.pad_collate,
-                          pin_memory=(hp.device != 'cpu'),
-                          shuffle=(not args.save),
+                          **kwargs_loader,
+                          **kwargs_sampler,
                           )
 loader_valid = DataLoader(dataset_valid,
                           batch_size=hp.batch_size,
                           num_workers=hp.num_workers,
                           collate_fn=dataset_valid.pad_collate,
-                          pin_memory=(hp.device != 'cpu'),
+                          **kwargs_loader,
                           shuffle=False,
                           )
 
@@ -167,7 +191,7 @@ elif args.test:  # args.test
                         batch_size=1,
                         num_workers=hp.num_workers,
                         collate_fn=dataset_test.pad_collate,
-                        pin_memory=(hp.device != 'cpu'),
+                        **kwargs_loader,
                         shuffle=False,
                         )
 
@@ -186,7 +210,7 @@ else:
                             batch_size=hp.batch_size,
                             num_workers=hp.num_workers,
                             collate_fn=dataset_test.pad_collate,
-                            pin_memory=(hp.device != 'cpu'),
+                            **kwargs_loader,
                             shuffle=False,
                             )
     # noinspection PyUnboundLocalVariable
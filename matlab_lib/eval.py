@@ -1,5 +1,4 @@
 import inspect
-import io
 from typing import Tuple, Sequence
 
 import numpy as np
@@ -24,41 +23,96 @@ class CallableSingletonMeta(type):
                 return type.__call__(cls, *args, **kwargs)
 
 
+# critical band filters of `fwseg.m` (center frequency and bandwidth in Hz)
+_CENT_FREQ = np.array([
+    50.0000, 120.000, 190.000, 260.000, 330.000, 400.000, 470.000, 540.000, 617.372,
+    703.378, 798.717, 904.128, 1020.38, 1148.30, 1288.72, 1442.54, 1610.70, 1794.16,
+    1993.93, 2211.08, 2446.71, 2701.97, 2978.04, 3276.17, 3597.63,
+])
+_BANDWIDTH = np.array([
+    70.0000, 70.0000, 70.0000, 70.0000, 70.0000, 70.0000, 70.0000, 77.3724, 86.0056,
+    95.3398, 105.411, 116.256, 127.914, 140.423, 153.823, 168.154, 183.457, 199.776,
+    217.153, 235.631, 255.255, 276.072, 298.126, 321.465, 346.136,
+])
+
+
+def fwsegsnr(clean: ndarray, processed: ndarray, fs: int) -> float:
+    """ frequency-weighted segmental SNR. The same as `fwsegsnr.m` (mean of `fwseg.m`)
+    but all frames are processed at once.
+
+    """
+    winlength = round(30 * fs / 1000)
+    skiprate = winlength // 4
+    max_freq = fs / 2
+    n_fft = int(2**np.ceil(np.log2(2 * winlength)))
+    n_fftby2 = n_fft // 2
+    gamma = 0.2
+
+    # Gaussianly shaped filters less than -30 dB are set to zero.
+    min_factor = np.exp(-30.0 / (2.0 * 2.303))
+    f0 = np.floor(_CENT_FREQ / max_freq * n_fftby2)[:, np.newaxis]
+    bw = (_BANDWIDTH / max_freq * n_fftby2)[:, np.newaxis]
+    norm_factor = (np.log(_BANDWIDTH[0]) - np.log(_BANDWIDTH))[:, np.newaxis]
+    j = np.arange(n_fftby2)
+    crit_filter = np.exp(-11 * ((j - f0) / bw)**2 + norm_factor)
+    crit_filter *= crit_filter > min_factor  # n_crit x n_fftby2
+
+    num_frames = (len(clean) - winlength) // skiprate  # the same no. of frames as fwseg.m
+    window = 0.5 * (1 - np.cos(2 * np.pi * np.arange(1, winlength + 1) / (winlength + 1)))
+
+    energies = []
+    for speech in (clean, processed):
+        speech = np.ascontiguousarray(speech, dtype=np.float64)
+        frames = np.lib.stride_tricks.as_strided(
+            speech, (num_frames, winlength), (speech.strides[0] * skiprate, speech.strides[0])
+        ) * window
+        spec = np.abs(np.fft.fft(frames, n_fft, axis=1))[:, :n_fftby2]
+        spec /= spec.sum(axis=1, keepdims=True)  # normalize spectra to have area of one
+        energies.append(spec @ crit_filter.T)  # n_frames x n_crit
+    clean_energy, processed_energy = energies
+
+    error_energy = np.maximum((clean_energy - processed_energy)**2, np.finfo(np.float64).eps)
+    W_freq = clean_energy**gamma
+    SNRlog = 10 * np.log10(clean_energy**2 / error_energy)
+    fwSNR = (W_freq * SNRlog).sum(axis=1) / W_freq.sum(axis=1)
+
+    return float(np.clip(fwSNR, -10, 35).mean())
+
+
+def mos2pesq(mos: float) -> float:
+    """ MOS-LQO -> raw PESQ score (inverse of ITU-T P.862.1). The same as `mos2pesq.m`.
+
+    """
+    a, c, d = 0.999, -1.4945, 4.6607
+    b = 4.999 - a
+    return float((np.log(b / (mos - a) - 1) - d) / c)
+
+
 class Evaluation(metaclass=CallableSingletonMeta):
-    __slots__ = ('eng', 'strio')
+    """ fwSegSNR, PESQ, STOI. The same metrics as `se_eval.m`
+    calculated by `pesq` (ITU-T P.862 C implementation) and `pystoi` without MATLAB.
+
+    """
+    __slots__ = ()
 
     instance = None
     metrics = ('fwSegSNR', 'PESQ', 'STOI')
 
     def __init__(self):
-        try:
-            import matlab.engine
-        finally:
-            pass
-        self.eng = matlab.engine.start_matlab('-nojvm')
-        self.eng.addpath(self.eng.genpath('./matlab_lib'))
-        # self.eng.maxNumCompThreads(os.cpu_count()//4)
-        self.strio = io.StringIO()
         Evaluation.instance: Evaluation = self
 
     def __call__(self, clean: ndarray, noisy: ndarray, fs: int) -> Tuple[Sequence[str], tuple]:
-        import matlab
-        clean = matlab.double(clean.tolist())
-        noisy = matlab.double(noisy.tolist())
-        fs = matlab.double([fs])
-        results = self.eng.se_eval(clean, noisy, fs, nargout=3, stdout=self.strio)
-
-        return Evaluation.metrics, results
+        from pesq import pesq
+        from pystoi import stoi
 
-    def _exit(self):
-        self.eng.quit()
+        # `pesq_mex_vec.m` normalizes both signals by the max. value (narrowband mode)
+        max_val = max(-clean.min(), clean.max(), -noisy.min(), noisy.max())
+        if max_val == 0:  # all-zero signals can't be evaluated
+            return Evaluation.metrics, (float('nan'),) * len(Evaluation.metrics)
 
-        # fname = datetime.now().strftime('log_matlab_eng_%Y-%m-%d %H.%M.%S.txt')
-        # with io.open(fname, 'w') as flog:
-        #     self.strio.seek(0)
-        #     shutil.copyfileobj(self.strio, flog)
+        fwsnr = fwsegsnr(clean, noisy, fs)
+        pesq_val = mos2pesq(pesq(fs, clean / max_val, noisy / max_val, 'nb'))
 
-        self.strio.close()
+        stoi_val = stoi(clean.astype(np.float64), noisy.astype(np.float64), fs, extended=False)
 
-    def __del__(self):
-        self._exit()
+        return Evaluation.metrics, (fwsnr, pesq_val, stoi_val)
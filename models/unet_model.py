@@ -4,12 +4,16 @@ Based on FusionNet
 
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from .unet_parts import InConv, DownAndConv, UpAndConv, OutConv
 
 
 class UNet(nn.Module):
-    def __init__(self, ch_in, ch_out, ch_base=32, depth=4, kernel_size=(3, 3)):
+    def __init__(self, ch_in, ch_out, ch_base=32, depth=4, kernel_size=(3, 3),
+                 use_checkpoint=False):
         super().__init__()
+        # If True, the activations inside each down/up block are recomputed in backward.
+        self.use_checkpoint = use_checkpoint
         self.inc = InConv(ch_in, ch_base,
                           kernel_size=kernel_size)
 
@@ -26,16 +30,22 @@ class UNet(nn.Module):
 
         self.outc = OutConv(ch_base, ch_out)
 
+    def _run(self, block: nn.Module, *args):
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(block, *args, use_reentrant=False)
+        else:
+            return block(*args)
+
     def forward(self, xin):
         xs_skip = [self.inc(xin)]
 
         for down in self.downs[:-1]:
-            xs_skip.append(down(xs_skip[-1]))
+            xs_skip.append(self._run(down, xs_skip[-1]))
 
-        x = self.downs[-1](xs_skip[-1])
+        x = self._run(self.downs[-1], xs_skip[-1])
 
         for item_skip, up in zip(reversed(xs_skip), self.ups):
-            x = up(x, item_skip)
+            x = self._run(up, x, item_skip)
 
         x = self.outc(x)
         return x
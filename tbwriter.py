@@ -1,4 +1,5 @@
 import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
 from typing import Dict
 from pathlib import Path
 
@@ -11,17 +12,28 @@ from torch.utils.tensorboard import SummaryWriter
 from audio_utils import (calc_snrseg,
                          calc_using_eval_module,
                          draw_spectrogram,
+                         spectrogram_to_image,
                          EVAL_METRICS,
                          reconstruct_wave,
+                         reconstruct_wave_torch,
                          )
 from dataset import LogModule
 from hparams import hp
 
 
 class CustomWriter(SummaryWriter):
-    def __init__(self, *args, group='', **kwargs):
+    def __init__(self, *args, group='', device='cpu', **kwargs):
+        """
+
+        :param group: prefix of tags
+        :param device: torch device where griffin-lim is done (the output device of Trainer)
+        """
+        # The event file is flushed when `max_queue` events are queued (default 10).
+        # write_one adds about 10 events per call, so it is increased.
+        kwargs.setdefault('max_queue', 100)
         super().__init__(*args, **kwargs)
         self.group = group
+        self.device = device
         if group == 'train':
             dict_custom_scalars = dict(
                 loss=['Multiline', ['loss/train', 'loss/valid']]
@@ -42,7 +54,11 @@ class CustomWriter(SummaryWriter):
 
         self.add_custom_scalars({group: dict_custom_scalars})
 
-        self.pool_eval_module = mp.pool.ThreadPool(1)
+        # PESQ, STOI are CPU-bound, so they are calculated in other processes.
+        # The spawned processes import `hparams` again without the parsed arguments,
+        # so values of `hp` are given explicitly (see `calc_using_eval_module`).
+        self.pool_eval_module = ProcessPoolExecutor(max_workers=hp.num_eval_workers,
+                                                    mp_context=mp.get_context('spawn'))
 
         # x, y
         self.reused_sample = dict()
@@ -51,10 +67,12 @@ class CustomWriter(SummaryWriter):
 
         # fig
         self.pad_min = None
+        self.fig_buf = None  # F x T_x x C buffer whose tail is filled with `pad_min`
         self.kwargs_fig = dict()
 
         # audio
         self.y_scale = 1.
+        self.wav_buf = np.empty(0, dtype=np.float32)  # reused by `add_scaled_audio`
 
     def add_scalar(self, tag, scalar_value, global_step=None, walltime=None):
         if not tag.startswith('loss'):
@@ -65,23 +83,54 @@ class CustomWriter(SummaryWriter):
         tag = f'{self.group}/{tag}'
         super().add_figure(tag, figure, global_step, close, walltime)
 
+    def add_image(self, tag, img_tensor, global_step=None, walltime=None, dataformats='CHW'):
+        tag = f'{self.group}/{tag}'
+        super().add_image(tag, img_tensor, global_step, walltime, dataformats)
+
+    def add_spectrogram(self, tag, data: ndarray, global_step=None, **kwargs):
+        """ add spectrogram as a matplotlib figure if `hp.use_matplotlib_fig`,
+        otherwise as an image without rendering a figure (much faster).
+
+        :param kwargs: vmin, vmax
+        """
+        if hp.use_matplotlib_fig:
+            self.add_figure(tag, draw_spectrogram(data, **kwargs), global_step)
+        else:
+            self.add_image(tag, spectrogram_to_image(data, **kwargs), global_step,
+                           dataformats='HWC')
+
     def add_audio(self, tag, snd_tensor, global_step=None, sample_rate=44100, walltime=None):
         tag = f'{self.group}/{tag}'
         if isinstance(snd_tensor, ndarray):
             snd_tensor = torch.from_numpy(snd_tensor)
         super().add_audio(tag, snd_tensor, global_step, hp.fs, walltime)
 
+    def add_scaled_audio(self, tag, wave: ndarray, scale: float, global_step=None):
+        """ add_audio of `wave / scale`. The result is written in the reused buffer
+        because `add_audio` encodes the audio before it returns.
+
+        """
+        if self.wav_buf.shape[0] < wave.shape[0] or self.wav_buf.dtype != wave.dtype:
+            self.wav_buf = np.empty(wave.shape[0], dtype=wave.dtype)
+        buf = self.wav_buf[:wave.shape[0]]
+        np.divide(wave, scale, out=buf)
+        self.add_audio(tag, buf, global_step)
+
     def add_text(self, tag, text_string, global_step=None, walltime=None):
         tag = f'{self.group}/{tag}'
         super().add_text(tag, text_string, global_step, walltime)
 
+    def close(self):
+        super().close()
+        self.pool_eval_module.shutdown(wait=True)
+
     def write_one(self, step: int,
                   out: ndarray = None,
                   eval_with_y_ph=False, **kwargs: ndarray) -> ndarray:
         """ write summary about one sample of output(and x and y optionally).
 
         :param step:
-        :param out:
+        :param out: nonnegative magnitude (clamped in `Trainer.postprocess`)
         :param eval_with_y_ph: if true, out reconstructed with true phase is evaluated.
         :param kwargs: keywords can be [x, y, x_phase, y_phase, path_feature]
 
@@ -98,9 +147,9 @@ class CustomWriter(SummaryWriter):
         # x_wav = self.reused_sample['x_wav']
         y_wav = self.reused_sample['y_wav']
 
-        np.maximum(out, 0, out=out)
-
-        if not eval_with_y_ph or (hp.add_test_audio or self.group == 'train'):
+        # Each reconstruction is done only if it is evaluated or added to tensorboard.
+        add_audio = hp.add_test_audio or self.group == 'train'
+        if not eval_with_y_ph or add_audio:
             if hp.use_das_phase:
                 path_feature = Path(self.reused_sample['path_feature'])
                 path = Path(
@@ -108,21 +157,22 @@ class CustomWriter(SummaryWriter):
                 ).with_suffix('.npy')
                 x_phase = np.load(path)
 
-            out_wav = reconstruct_wave(out, x_phase[:, :out.shape[1]],
-                                       n_iter=hp.n_gla_iter,
-                                       momentum=hp.momentum_gla,
-                                       )
+            out_wav = reconstruct_wave_torch(out, x_phase[:, :out.shape[1]],
+                                             n_iter=hp.n_gla_iter,
+                                             momentum=hp.momentum_gla,
+                                             device=self.device,
+                                             )
         else:
             out_wav = None
 
-        if eval_with_y_ph or (hp.add_test_audio or self.group == 'train'):
+        if eval_with_y_ph or add_audio:
             out_wav_y_ph = reconstruct_wave(out, y_phase)
         else:
             out_wav_y_ph = None
 
-        result_eval = self.pool_eval_module.apply_async(
+        result_eval = self.pool_eval_module.submit(
             calc_using_eval_module,
-            (y_wav, out_wav_y_ph if eval_with_y_ph else out_wav)
+            y_wav, out_wav_y_ph if eval_with_y_ph else out_wav, fs=hp.fs,
         )
         # dict_eval = calc_using_eval_module(
         #     y_wav,
@@ -131,22 +181,21 @@ class CustomWriter(SummaryWriter):
         snrseg = calc_snrseg(y, out)
 
         if hp.draw_test_fig or self.group == 'train':
-            fig_out = draw_spectrogram(np.append(out, self.pad_min, axis=1),
-                                       **self.kwargs_fig)
-
-            self.add_figure('3_Estimated Anechoic Spectrum', fig_out, step)
+            self.add_spectrogram('3_Estimated Anechoic Spectrum',
+                                 self._append_pad_min(out), step,
+                                 **self.kwargs_fig)
 
-        if hp.add_test_audio or self.group == 'train':
-            self.add_audio('3_Estimated Anechoic Wave', out_wav / self.y_scale, step)
-            self.add_audio('4_Estimated Wave with Anechoic Phase',
-                           out_wav_y_ph / self.y_scale, step)
+        if add_audio:
+            self.add_scaled_audio('3_Estimated Anechoic Wave', out_wav, self.y_scale, step)
+            self.add_scaled_audio('4_Estimated Wave with Anechoic Phase',
+                                  out_wav_y_ph, self.y_scale, step)
 
         self.add_scalar('1_SNRseg/Reverberant', self.snrseg_x, step)
         self.add_scalar('1_SNRseg/Proposed', snrseg, step)
 
         if result_eval_x:
-            self.dict_eval_x = result_eval_x.get()
-        dict_eval = result_eval.get()
+            self.dict_eval_x = result_eval_x.result()
+        dict_eval = result_eval.result()
         for i, m in enumerate(dict_eval.keys()):
             j = i + 2
             self.add_scalar(f'{j}_{m}/Reverberant', self.dict_eval_x[m], step)
@@ -156,7 +205,17 @@ class CustomWriter(SummaryWriter):
                        [self.snrseg_x, *self.dict_eval_x.values()]]
         return np.array(all_results, dtype=np.float32)
 
-    def _write_x_y(self, kwargs: Dict[str, ndarray], step: int) -> mp.pool.AsyncResult:
+    def _append_pad_min(self, a: ndarray) -> ndarray:
+        """ `np.append(a, self.pad_min, axis=1)` written in the reused buffer `self.fig_buf`
+
+        """
+        T = a.shape[1]
+        if T + self.pad_min.shape[1] != self.fig_buf.shape[1] or a.dtype != self.fig_buf.dtype:
+            return np.append(a, self.pad_min, axis=1)
+        self.fig_buf[:, :T] = a
+        return self.fig_buf
+
+    def _write_x_y(self, kwargs: Dict[str, ndarray], step: int) -> Future:
         """ write x (input) and y (desired output)
 
         """
@@ -171,11 +230,11 @@ class CustomWriter(SummaryWriter):
         x_wav = reconstruct_wave(x, x_phase)
         y_wav = reconstruct_wave(y, y_phase)
 
-        self.y_scale = np.abs(y_wav).max() / 0.5
+        self.y_scale = max(-y_wav.min(), y_wav.max()) / 0.5  # max(abs) without a temporary
 
-        result_eval_x = self.pool_eval_module.apply_async(
+        result_eval_x = self.pool_eval_module.submit(
             calc_using_eval_module,
-            (y_wav, x_wav[:y_wav.shape[0]])
+            y_wav, x_wav[:y_wav.shape[0]], fs=hp.fs,
         )
         # result_eval_x = None
         # self.dict_eval_x = calc_using_eval_module(y_wav, x_wav[:y_wav.shape[0]])
@@ -183,18 +242,18 @@ class CustomWriter(SummaryWriter):
         if hp.draw_test_fig or self.group == 'train':
             ymin = y[y > 0].min()
             self.pad_min = np.full((y.shape[0], x.shape[1] - y.shape[1], y.shape[2]), ymin)
+            self.fig_buf = np.empty((y.shape[0], x.shape[1], y.shape[2]), dtype=y.dtype)
+            self.fig_buf[:, y.shape[1]:] = self.pad_min
             vmin, vmax = 20 * LogModule.log_(np.array((ymin, y.max())))
             self.kwargs_fig = dict(vmin=vmin, vmax=vmax)
 
-            fig_x = draw_spectrogram(x)
-            fig_y = draw_spectrogram(np.append(y, self.pad_min, axis=1))
-
-            self.add_figure('1_Anechoic Spectrum', fig_y, step)
-            self.add_figure('2_Reverberant Spectrum', fig_x, step)
+            self.add_spectrogram('1_Anechoic Spectrum', self._append_pad_min(y), step)
+            self.add_spectrogram('2_Reverberant Spectrum', x, step)
 
         if hp.add_test_audio or self.group == 'train':
-            self.add_audio('1_Anechoic Wave', y_wav / self.y_scale, step)
-            self.add_audio('2_Reverberant Wave', x_wav / (np.abs(x_wav).max() / 0.5), step)
+            self.add_scaled_audio('1_Anechoic Wave', y_wav, self.y_scale, step)
+            self.add_scaled_audio('2_Reverberant Wave',
+                                  x_wav, max(-x_wav.min(), x_wav.max()) / 0.5, step)
 
         self.reused_sample = dict(x=x, y=y,
                                   x_phase=x_phase, y_phase=y_phase,
@@ -1,12 +1,18 @@
+import contextlib
+import threading
+from datetime import timedelta
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Dict, Sequence, Tuple, Optional, Any, Callable
 from collections import defaultdict
 
 import torch
+import torch.distributed as dist
 from numpy import ndarray
 import scipy.io as scio
 from torch import nn, Tensor
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from torchsummary import summary
 from tqdm import tqdm
 
@@ -66,12 +72,31 @@ class Trainer:
 
         self.__init_device(hp.device, hp.out_device)
 
+        # autocast & channels_last memory format (Tensor Core convolution kernels)
+        # bfloat16 for compute capability >= 8,
+        # float16 with loss scaling for 7.x only if `hp.use_amp_fp16`
+        capability = (torch.cuda.get_device_capability(self.in_device)[0]
+                      if self.in_device.type == 'cuda' else 0)
+        self.use_amp = hp.use_amp and (capability >= 8 or hp.use_amp_fp16 and capability == 7)
+        self.amp_dtype = torch.bfloat16 if capability >= 8 else torch.float16
+        if self.use_amp:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=(self.use_amp and self.amp_dtype == torch.float16)
+        )
+
         self.scheduler: Optional[CosineLRWithRestarts] = None
         self.max_epochs = hp.n_epochs
         self.loss_last_restart = float('inf')
 
         self.writer: Optional[CustomWriter] = None
 
+        # thread saving the state dict (see `save_state`)
+        self.thread_save: Optional[threading.Thread] = None
+
+        # frame indices used for the mask of `calc_loss` (extended if longer data comes)
+        self.arange_frames = torch.arange(0)
+
         # a sample in validation set for evaluation
         self.valid_eval_sample: Dict[str, Any] = dict()
 
@@ -79,16 +104,13 @@ class Trainer:
         if path_state_dict:
             st_model, st_optim = torch.load(path_state_dict, map_location=self.in_device)
             try:
-                if hasattr(self.model, 'module'):
-                    self.model.module.load_state_dict(st_model)
-                else:
-                    self.model.load_state_dict(st_model)
+                self.raw_model.load_state_dict(st_model)
                 self.optimizer.load_state_dict(st_optim)
             except:
                 raise Exception('The model is different from the state dict.')
 
         path_summary = hp.logdir / 'summary.txt'
-        if not path_summary.exists():
+        if self.rank == 0 and not path_summary.exists():
             print_to_file(
                 path_summary,
                 summary,
@@ -98,6 +120,17 @@ class Trainer:
             with (hp.logdir / 'hparams.txt').open('w') as f:
                 f.write(repr(hp))
 
+        # gradients are all-reduced by NCCL while the backward propagation is being done.
+        if hp.local_rank >= 0:
+            self.model = DistributedDataParallel(self.model,
+                                                 device_ids=[hp.local_rank],
+                                                 output_device=hp.local_rank)
+
+        # TorchInductor code generation. The no. of frames differs by batch,
+        # so the time axis is compiled as a dynamic dimension (compiled at the first batch).
+        if hp.compile_model:
+            self.model = torch.compile(self.model, mode=hp.compile_mode, dynamic=True)
+
     def __init_device(self, device, out_device):
         """
 
@@ -105,7 +138,19 @@ class Trainer:
         :type out_device: Union[int, str, Sequence]
         :return:
         """
-        if device == 'cpu':
+        # streams for host-to-device copies of each device (see `preprocess`)
+        self.copy_streams: Dict[torch.device, torch.cuda.Stream] = dict()
+        self.rank = hp.rank  # only rank 0 writes summaries and state dicts
+        if hp.local_rank >= 0:
+            # one process per GPU. The model is wrapped by DDP in `__init__`.
+            torch.cuda.set_device(hp.local_rank)
+            dist.init_process_group(backend='nccl')
+            # The other processes wait in this group while rank 0 validates,
+            # so the timeout of NCCL collectives isn't reached during a long validation.
+            self.group_wait = dist.new_group(backend='gloo', timeout=timedelta(days=1))
+            device = hp.local_rank
+            out_device = hp.local_rank
+        elif device == 'cpu':
             self.in_device = torch.device('cpu')
             self.out_device = torch.device('cpu')
             self.str_device = 'cpu'
@@ -141,36 +186,126 @@ class Trainer:
 
         torch.cuda.set_device(self.in_device)
 
+        # cuDNN chooses the fastest convolution algorithms for each input shape (cached).
+        # TF32 Tensor Core math for float32 convolutions and matmuls (compute capability >= 8).
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+        for d in (self.in_device, self.out_device):
+            self.copy_streams[d] = torch.cuda.Stream(device=d)
+
+    @property
+    def raw_model(self) -> nn.Module:
+        """ the model not wrapped by torch.compile, nn.DataParallel or DistributedDataParallel
+
+        """
+        model = getattr(self.model, '_orig_mod', self.model)
+        if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+            model = model.module
+        return model
+
+    def autocast(self):
+        """ autocast context if `self.use_amp`.
+        `self.scaler` is enabled only for float16
+        because bfloat16 has the same exponent range as float32.
+
+        """
+        return torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp)
+
     def preprocess(self, data: Dict[str, Tensor]) -> Tuple[Tensor, Tensor]:
         # B, F, T, C
         x = data['normalized_x']
         y = data['normalized_y']
 
-        x = x.to(self.in_device, non_blocking=True)
-        y = y.to(self.out_device, non_blocking=True)
+        x = self._copy_to(x, self.in_device,
+                          memory_format=torch.channels_last if self.use_amp
+                          else torch.preserve_format)
+        y = self._copy_to(y, self.out_device)
 
         return x, y
 
+    def _copy_to(self, a: Tensor, device: torch.device, **kwargs) -> Tensor:
+        """ copy `a` to `device` in the copy stream
+        so that the copy of pinned `a` is overlapped with the computation being queued.
+
+        """
+        if device not in self.copy_streams:
+            return a.to(device, non_blocking=True, **kwargs)
+
+        stream = self.copy_streams[device]
+        with torch.cuda.stream(stream):
+            a = a.to(device, non_blocking=True, **kwargs)
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(stream)
+        a.record_stream(current_stream)  # `a` is used in the current stream
+        return a
+
     @torch.no_grad()
     def postprocess(self, output: Tensor, Ts: ndarray, idx: int,
-                    dataset: DirSpecDataset) -> Dict[str, ndarray]:
+                    dataset: DirSpecDataset, non_blocking=False) -> Dict[str, ndarray]:
+        """ denormalized output of `idx`-th sample of the batch
+
+        :param non_blocking: If True, the device-to-host copy is only queued,
+            so the returned array is valid after the current stream is synchronized.
+        """
         one = output[idx, :, :, :Ts[idx]]
         if self.model_name.startswith('UNet'):
             one = one.permute(1, 2, 0)  # F, T, C
 
         one = dataset.denormalize_(y=one)
-        one = one.cpu().numpy()
+        one = one.clamp_(min=0)  # nonnegative magnitude
+        one = one.to('cpu', non_blocking=non_blocking).numpy()
 
         return dict(out=one)
 
     def calc_loss(self, output: Tensor, y: Tensor, T_ys: Sequence[int]) -> Tensor:
-        loss_batch = self.criterion(output, y)
-        loss = torch.zeros(1, device=loss_batch.device)
-        for T, loss_sample in zip(T_ys, loss_batch):
-            loss += torch.sum(loss_sample[:, :, :T]) / T
+        loss_batch = self.criterion(output, y)  # B, C, F, T
+
+        # sum of each sample in its own length / the length (one masked reduction)
+        T_max = loss_batch.shape[-1]
+        if (len(self.arange_frames) < T_max
+                or self.arange_frames.device != loss_batch.device):
+            self.arange_frames = torch.arange(T_max, device=loss_batch.device)
+        T_ys = torch.as_tensor(T_ys).to(loss_batch.device, non_blocking=True)
+        mask = self.arange_frames[:T_max] < T_ys[:, None]
+        loss_sample = (loss_batch * mask[:, None, None, :]).sum(dim=(1, 2, 3))
+        loss = (loss_sample / T_ys).sum()
 
         return loss
 
+    def save_state(self, path: Path):
+        """ save the state dicts of the model and the optimizer.
+
+        The state dicts are copied to the host at once, and the file is written in a thread
+        so that the training is not blocked by writing the file.
+        """
+        def to_cpu(obj):
+            if isinstance(obj, Tensor):
+                if obj.device.type == 'cpu':
+                    # snapshot (not the same storage that the next optimizer step modifies)
+                    return obj.detach().clone()
+                return obj.detach().to('cpu', non_blocking=True)
+            elif isinstance(obj, dict):
+                return {k: to_cpu(v) for k, v in obj.items()}
+            elif isinstance(obj, (list, tuple)):
+                return type(obj)(to_cpu(v) for v in obj)
+            else:
+                return obj
+
+        if self.rank != 0:
+            return
+        if self.thread_save:
+            self.thread_save.join()
+
+        state = to_cpu((self.raw_model.state_dict(), self.optimizer.state_dict()))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        self.thread_save = threading.Thread(target=torch.save, args=(state, path),
+                                            kwargs=dict(pickle_protocol=4))
+        self.thread_save.start()
+
     @torch.no_grad()
     def should_stop(self, loss_valid, epoch):
         if epoch == self.max_epochs - 1:
@@ -186,15 +321,19 @@ class Trainer:
 
     def train(self, loader_train: DataLoader, loader_valid: DataLoader,
               logdir: Path, first_epoch=0):
-        # Learning Rate Scheduler
+        # Learning Rate Scheduler (`batch_step` is called once per optimizer step)
+        # The sampler and the batch size of this process are used (DDP: a shard of the dataset).
         self.scheduler = CosineLRWithRestarts(self.optimizer,
-                                              batch_size=hp.batch_size,
-                                              epoch_size=len(loader_train.dataset),
+                                              batch_size=(loader_train.batch_size
+                                                          * hp.grad_accum_steps),
+                                              epoch_size=len(loader_train.sampler),
                                               last_epoch=first_epoch - 1,
                                               **hp.scheduler)
         self.scheduler.step()
 
-        self.writer = CustomWriter(str(logdir), group='train', purge_step=first_epoch)
+        if self.rank == 0:
+            self.writer = CustomWriter(str(logdir), group='train', device=self.out_device,
+                                       purge_step=first_epoch)
 
         # write DNN structure to tensorboard. not properly work in PyTorch 1.3
         # self.writer.add_graph(
@@ -204,10 +343,13 @@ class Trainer:
 
         # Start Training
         for epoch in range(first_epoch, hp.n_epochs):
+            if isinstance(loader_train.sampler, DistributedSampler):
+                loader_train.sampler.set_epoch(epoch)  # different shuffling for each epoch
 
             print()
             pbar = tqdm(loader_train,
-                        desc=f'epoch {epoch:3d}', postfix='[]', dynamic_ncols=True)
+                        desc=f'epoch {epoch:3d}', postfix='[]', dynamic_ncols=True,
+                        mininterval=0.5, disable=(self.rank != 0))
             avg_loss = AverageMeter(float)
 
             for i_iter, data in enumerate(pbar):
@@ -215,41 +357,63 @@ class Trainer:
                 x, y = self.preprocess(data)  # B, C, F, T
                 T_ys = data['T_ys']
 
-                # forward
-                output = self.model(x)[..., :y.shape[-1]]  # B, C, F, T
-
-                loss = self.calc_loss(output, y, T_ys)
-
-                # backward
-                self.optimizer.zero_grad()
-                loss.backward()
-
-                self.optimizer.step()
-                self.scheduler.batch_step()
-
-                # print
-                avg_loss.update(loss.item(), len(T_ys))
-                pbar.set_postfix_str(f'{avg_loss.get_average():.1e}')
-
-            self.writer.add_scalar('loss/train', avg_loss.get_average(), epoch)
-
-            # Validation
-            loss_valid = self.validate(loader_valid, logdir, epoch)
+                # gradients are accumulated for `hp.grad_accum_steps` batches.
+                # DDP doesn't all-reduce the gradients until the last one.
+                do_step = ((i_iter + 1) % hp.grad_accum_steps == 0
+                           or i_iter == len(loader_train) - 1)
+                # no. of batches of the current group (the last group can be shorter)
+                i_group_start = i_iter - i_iter % hp.grad_accum_steps
+                n_accum = min(hp.grad_accum_steps, len(loader_train) - i_group_start)
+                if not do_step and hasattr(self.model, 'no_sync'):
+                    context_sync = self.model.no_sync()
+                else:
+                    context_sync = contextlib.nullcontext()
+
+                with context_sync:
+                    # forward
+                    with self.autocast():
+                        output = self.model(x)[..., :y.shape[-1]]  # B, C, F, T
+
+                        loss = self.calc_loss(output, y, T_ys)
+
+                    # backward
+                    self.scaler.scale(loss / n_accum).backward()
+
+                if do_step:
+                    scale = self.scaler.get_scale() if self.scaler.is_enabled() else None
+                    self.scaler.step(self.optimizer)  # skipped if the gradients have inf/nan
+                    self.scaler.update()
+                    self.optimizer.zero_grad(set_to_none=True)
+                    # The scale is decreased only if the optimizer step was skipped.
+                    if scale is None or self.scaler.get_scale() >= scale:
+                        self.scheduler.batch_step()
+
+                # print (the loss is summed in the GPU, and copied to the host only for printing)
+                avg_loss.update(loss.detach(), len(T_ys))
+                if self.rank == 0 and i_iter % hp.period_print == 0:
+                    pbar.set_postfix_str(f'{avg_loss.get_average().item():.1e}', refresh=False)
+
+            # Validation (the loss of rank 0 only is written if DDP is used)
+            if self.rank == 0:
+                self.writer.add_scalar('loss/train', avg_loss.get_average().item(), epoch)
+                loss_valid = self.validate(loader_valid, logdir, epoch)
+            else:
+                loss_valid = None
+            if hp.local_rank >= 0:
+                dist.barrier(group=self.group_wait)
 
             # save loss & model
             if epoch % hp.period_save_state == hp.period_save_state - 1:
-                torch.save(
-                    (self.model.module.state_dict(),
-                     self.optimizer.state_dict(),
-                     ),
-                    logdir / f'{epoch}.pt'
-                )
+                self.save_state(logdir / f'{epoch}.pt')
 
             # Early stopping
             if self.should_stop(loss_valid, epoch):
                 break
 
-        self.writer.close()
+        if self.thread_save:
+            self.thread_save.join()
+        if self.writer:
+            self.writer.close()
 
     @torch.no_grad()
     def validate(self, loader: DataLoader, logdir: Path, epoch: int):
@@ -260,25 +424,31 @@ class Trainer:
         :param epoch:
         """
 
+        # Only rank 0 validates, so the forward of DDP (syncing BatchNorm buffers) isn't used.
+        model = self.raw_model if hp.local_rank >= 0 else self.model
+
         self.model.eval()
 
         avg_loss = AverageMeter(float)
 
-        pbar = tqdm(loader, desc='validate ', postfix='[0]', dynamic_ncols=True)
+        pbar = tqdm(loader, desc='validate ', postfix='[0]', dynamic_ncols=True,
+                    mininterval=0.5)
         for i_iter, data in enumerate(pbar):
             # get data
             x, y = self.preprocess(data)  # B, C, F, T
             T_ys = data['T_ys']
 
             # forward
-            output = self.model(x)[..., :y.shape[-1]]
+            with self.autocast():
+                output = model(x)[..., :y.shape[-1]].float()
 
-            # loss
-            loss = self.calc_loss(output, y, T_ys)
-            avg_loss.update(loss.item(), len(T_ys))
+                # loss
+                loss = self.calc_loss(output, y, T_ys)
+            avg_loss.update(loss.detach(), len(T_ys))
 
             # print
-            pbar.set_postfix_str(f'{avg_loss.get_average():.1e}')
+            if i_iter % hp.period_print == 0:
+                pbar.set_postfix_str(f'{avg_loss.get_average().item():.1e}', refresh=False)
 
             # write summary
             if i_iter == 0:
@@ -297,11 +467,14 @@ class Trainer:
 
                 self.writer.write_one(epoch, **one_sample, **out_one)
 
-        self.writer.add_scalar('loss/valid', avg_loss.get_average(), epoch)
+        loss_valid = avg_loss.get_average().item()
+        self.writer.add_scalar('loss/valid', loss_valid, epoch)
 
         self.model.train()
+        if self.in_device.type == 'cuda':
+            torch.cuda.empty_cache()  # release the blocks of validation-only shapes
 
-        return avg_loss.get_average()
+        return loss_valid
 
     @torch.no_grad()
     def test(self, loader: DataLoader, logdir: Path):
@@ -329,7 +502,7 @@ class Trainer:
 
         group = logdir.name.split('_')[0]
 
-        self.writer = CustomWriter(str(logdir), group=group)
+        self.writer = CustomWriter(str(logdir), group=group, device=self.out_device)
 
         avg_measure = None
         self.model.eval()
@@ -339,11 +512,7 @@ class Trainer:
         if hp.n_save_block_outs:
             module_counts = defaultdict(int)
             save_forward.writer = self.writer
-            if isinstance(self.model, nn.DataParallel):
-                module = self.model.module
-            else:
-                module = self.model
-            for sub in module.children():
+            for sub in self.raw_model.children():
                 if isinstance(sub, nn.ModuleList):
                     for m in sub:
                         m.register_forward_hook(save_forward)
@@ -353,6 +522,27 @@ class Trainer:
                 else:
                     sub.register_forward_hook(save_forward)
 
+        def write_summary(i_iter_, n_sample, one_sample, out_one, event):
+            nonlocal avg_measure
+            if event is not None:
+                event.synchronize()  # the copy of `out_one` is done
+
+            # DirSpecDataset.save_dirspec(
+            #     logdir / hp.form_result.format(i_iter_),
+            #     **one_sample, **out_one
+            # )
+
+            measure = self.writer.write_one(
+                i_iter_, eval_with_y_ph=hp.eval_with_y_ph, **out_one, **one_sample,
+            )
+            if avg_measure is None:
+                avg_measure = AverageMeter(init_value=measure, init_count=n_sample)
+            else:
+                avg_measure.update(measure)
+
+        # The summary of each iteration is written after the forward of the next iteration
+        # is queued, so the GPU isn't idle while the summary is being written.
+        pending = None
         pbar = tqdm(loader, desc=group, dynamic_ncols=True)
         for i_iter, data in enumerate(pbar):
             # get data
@@ -367,22 +557,20 @@ class Trainer:
                 break
             output = self.model(x)  # [..., :y.shape[-1]]
 
-            # write summary
             one_sample = DirSpecDataset.decollate_padded(data, 0)  # F, T, C
-            out_one = self.postprocess(output, T_ys, 0, loader.dataset)
+            out_one = self.postprocess(output, T_ys, 0, loader.dataset, non_blocking=True)
+            event = None
+            if output.is_cuda:
+                event = torch.cuda.Event()
+                event.record()
 
-            # DirSpecDataset.save_dirspec(
-            #     logdir / hp.form_result.format(i_iter),
-            #     **one_sample, **out_one
-            # )
+            # write summary
+            if pending is not None:
+                write_summary(*pending)
+            pending = (i_iter, len(T_ys), one_sample, out_one, event)
 
-            measure = self.writer.write_one(
-                i_iter, eval_with_y_ph=hp.eval_with_y_ph, **out_one, **one_sample,
-            )
-            if avg_measure is None:
-                avg_measure = AverageMeter(init_value=measure, init_count=len(T_ys))
-            else:
-                avg_measure.update(measure)
+        if pending is not None:
+            write_summary(*pending)
 
         self.model.train()
 
@@ -411,6 +599,12 @@ class Trainer:
 
         # avg_loss = AverageMeter(float)
 
+        # files are written in threads while the next batch is processed.
+        # The no. of pending writes is limited so that the results don't pile up in memory.
+        n_save_workers = 4
+        pool_save = ThreadPoolExecutor(max_workers=n_save_workers)
+        futures_save = set()
+
         pbar = tqdm(loader, desc='save ', dynamic_ncols=True)
         i_cum = 0
         for i_iter, data in enumerate(pbar):
@@ -422,27 +616,37 @@ class Trainer:
             output = self.model(x)[..., :y.shape[-1]]  # B, C, F, T
 
             output = output.permute(0, 2, 3, 1)  # B, F, T, C
-            out_denorm = loader.dataset.denormalize_(y=output).cpu().numpy()
-            np.maximum(out_denorm, 0, out=out_denorm)
+            out_denorm = loader.dataset.denormalize_(y=output).clamp_(min=0)
             out_denorm = out_denorm.squeeze()  # B, F, T
 
-            # B, F, T
-            x_phase = data['x_phase'][..., :y.shape[-1], 0].numpy()
-            y_phase = data['y_phase'].numpy().squeeze()
-            out_x_ph = out_denorm * np.exp(1j * x_phase)
-            out_y_ph = out_denorm * np.exp(1j * y_phase)
+            # B, F, T (complex spectrograms are made in the GPU and copied once)
+            x_phase = self._copy_to(data['x_phase'][..., :y.shape[-1], 0], out_denorm.device)
+            y_phase = self._copy_to(data['y_phase'].squeeze(), out_denorm.device)
+            out_x_ph = torch.polar(out_denorm, x_phase).cpu().numpy()
+            out_y_ph = torch.polar(out_denorm, y_phase).cpu().numpy()
+            out_denorm = out_denorm.cpu().numpy()
 
             for i_b, T, in enumerate(T_ys):
-                # F, T
-                noisy = np.ascontiguousarray(out_x_ph[i_b, ..., :T])
-                clean = np.ascontiguousarray(out_y_ph[i_b, ..., :T])
-                mag = np.ascontiguousarray(out_denorm[i_b, ..., :T])
+                # F, T (np.savez writes the views in C order without copying them.)
+                noisy = out_x_ph[i_b, ..., :T]
+                clean = out_y_ph[i_b, ..., :T]
+                mag = out_denorm[i_b, ..., :T]
                 length = hp.n_fft + hp.l_hop * (T - 1) - hp.n_fft // 2 * 2
 
                 spec_data = dict(spec_noisy=noisy, spec_clean=clean,
                                  mag_clean=mag, length=length
                                  )
-                np.savez(str(logdir / f'{i_cum + i_b}.npz'), **spec_data)
+                futures_save.add(
+                    pool_save.submit(np.savez, str(logdir / f'{i_cum + i_b}.npz'), **spec_data)
+                )
             i_cum += len(T_ys)
 
+            while len(futures_save) > 2 * n_save_workers:
+                done, futures_save = wait(futures_save, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # raise the exception in the thread if exists
+
+        for future in futures_save:
+            future.result()
+        pool_save.shutdown()
         self.model.train()
@@ -1,6 +1,7 @@
 import contextlib
-import gc
 import os
+import struct
+import zipfile
 from pathlib import Path
 from typing import Callable, Union, TypeVar
 
@@ -69,6 +70,35 @@ def convert(a: TensArr, astype: type, device: Union[int, torch.device] = None) -
         raise ValueError(astype)
 
 
+def load_npz_mmap(fname: Union[str, Path], key: str) -> ndarray:
+    """ memory-map an array in a npz file without loading it.
+    This works only for uncompressed npz files (saved by `np.savez`).
+    Otherwise, the array is loaded in memory.
+
+    """
+    with zipfile.ZipFile(fname) as zf:
+        info = zf.getinfo(f'{key}.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(fname) as npz:
+            return npz[key]
+
+    with open(fname, 'rb') as f:
+        # local file header: 30 bytes + file name + extra field
+        f.seek(info.header_offset + 26)
+        len_name, len_extra = struct.unpack('<HH', f.read(4))
+        f.seek(len_name + len_extra, os.SEEK_CUR)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(fname, dtype=dtype, mode='r', shape=shape,
+                     order='F' if fortran_order else 'C', offset=offset)
+
+
 def arr2str(a: np.ndarray, format_='e', ndigits=2) -> str:
     """convert ndarray of floats to a string expression.
 
@@ -77,10 +107,11 @@ def arr2str(a: np.ndarray, format_='e', ndigits=2) -> str:
     :param ndigits:
     :return:
     """
+    form = f'{{:.{ndigits}{format_}}}'.format  # the format spec is parsed once
     return np.array2string(
         a,
         formatter=dict(
-            float_kind=(lambda x: f'{x:.{ndigits}{format_}}' if x != 0 else '0')
+            float_kind=(lambda x: form(x) if x != 0 else '0')
         )
     )
 